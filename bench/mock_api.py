@@ -0,0 +1,152 @@
+"""Mock Altare API cho benchmark.
+
+Chạy riêng:  python -m bench.mock_api --port 8787 --latency 40 --error-rate 0.01
+Hoặc import start_mock() để chạy chung event loop với harness.
+
+Ngoài các endpoint thật còn có:
+    GET  /_stats  — số request theo loại/mã trả về và khoảng cách giữa các heartbeat mỗi tenant
+    POST /_reset  — xóa số liệu
+"""
+import asyncio
+import argparse
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+
+@dataclass
+class MockConfig:
+    latency_ms: float = 30.0   # độ trễ trung bình mỗi request
+    jitter_ms: float = 10.0    # ± ngẫu nhiên quanh latency_ms
+    error_rate: float = 0.0    # tỉ lệ trả HTTP 500
+    rate_429: float = 0.0      # tỉ lệ trả HTTP 429
+    timeout_rate: float = 0.0  # tỉ lệ treo hang_secs (quá timeout của client)
+    hang_secs: float = 20.0
+
+
+@dataclass
+class MockStats:
+    requests: Counter = field(default_factory=Counter)
+    statuses: Counter = field(default_factory=Counter)
+    last_hb: dict = field(default_factory=dict)
+    hb_gaps: list = field(default_factory=list)
+
+    def reset(self):
+        self.requests.clear()
+        self.statuses.clear()
+        self.last_hb.clear()
+        self.hb_gaps.clear()
+
+
+def _tenant_for(token: str) -> str:
+    return "t-" + token[-12:]
+
+
+def build_app(cfg: MockConfig) -> web.Application:
+    stats = MockStats()
+
+    async def _simulate(op: str):
+        stats.requests[op] += 1
+        delay = max(cfg.latency_ms + random.uniform(-cfg.jitter_ms, cfg.jitter_ms), 0) / 1000
+        roll = random.random()
+        if roll < cfg.timeout_rate:
+            await asyncio.sleep(cfg.hang_secs)
+        elif delay:
+            await asyncio.sleep(delay)
+        roll -= cfg.timeout_rate
+        if roll < cfg.rate_429:
+            return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "1"})
+        roll -= cfg.rate_429
+        if roll < cfg.error_rate:
+            return web.json_response({"error": "internal"}, status=500)
+        return None
+
+    async def tenants(request: web.Request):
+        err = await _simulate("tenants")
+        if err is not None:
+            stats.statuses[err.status] += 1
+            return err
+        token = request.headers.get("Authorization", "")
+        if not token:
+            stats.statuses[401] += 1
+            return web.json_response({"error": "unauthorized"}, status=401)
+        stats.statuses[200] += 1
+        return web.json_response({"items": [{"id": _tenant_for(token)}]})
+
+    async def afk(request: web.Request):
+        op = request.match_info["op"]
+        if op not in ("start", "stop", "heartbeat"):
+            raise web.HTTPNotFound()
+        err = await _simulate(op)
+        if err is not None:
+            stats.statuses[err.status] += 1
+            return err
+        if op == "heartbeat":
+            tid = request.match_info["tenant_id"]
+            now = time.monotonic()
+            prev = stats.last_hb.get(tid)
+            if prev is not None:
+                stats.hb_gaps.append(now - prev)
+            stats.last_hb[tid] = now
+        stats.statuses[200] += 1
+        return web.json_response({"ok": True})
+
+    async def get_stats(request: web.Request):
+        return web.json_response({
+            "requests": dict(stats.requests),
+            "statuses": {str(k): v for k, v in stats.statuses.items()},
+            "hb_gaps": stats.hb_gaps,
+        })
+
+    async def reset(request: web.Request):
+        stats.reset()
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_get("/api/tenants", tenants)
+    app.router.add_post("/api/tenants/{tenant_id}/rewards/afk/{op}", afk)
+    app.router.add_get("/_stats", get_stats)
+    app.router.add_post("/_reset", reset)
+    return app
+
+
+async def start_mock(cfg: MockConfig, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    """Chạy mock trong event loop hiện tại. Trả (runner, base_url); port=0 để tự chọn cổng trống."""
+    runner = web.AppRunner(build_app(cfg), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def add_mock_args(p: argparse.ArgumentParser):
+    p.add_argument("--latency", type=float, default=30.0, help="ms trung bình mỗi request")
+    p.add_argument("--jitter", type=float, default=10.0, help="ms dao động quanh latency")
+    p.add_argument("--error-rate", type=float, default=0.0, help="tỉ lệ HTTP 500")
+    p.add_argument("--rate-429", type=float, default=0.0, help="tỉ lệ HTTP 429")
+    p.add_argument("--timeout-rate", type=float, default=0.0, help="tỉ lệ request bị treo")
+    p.add_argument("--hang", type=float, default=20.0, help="giây treo với request timeout")
+
+
+def mock_config(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate,
+        rate_429=args.rate_429, timeout_rate=args.timeout_rate, hang_secs=args.hang,
+    )
+
+
+def main():
+    p = argparse.ArgumentParser(description="Mock Altare API")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8787)
+    add_mock_args(p)
+    args = p.parse_args()
+    web.run_app(build_app(mock_config(args)), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Benchmark tải cho farm, chạy trên mock Altare API.
+
+    python -m bench.run --sizes 10,100,1000 --duration 60 --hb-interval 5 --out bench/result.json
+
+Mỗi kích thước: tạo DB tạm với N token giả, boot bằng load_all_tokens, đo trong --duration giây
+rồi gỡ toàn bộ session. Mặc định mock chạy chung event loop; dùng --mock-url để trỏ tới mock
+chạy riêng (python -m bench.mock_api) nếu muốn tách CPU của mock khỏi số đo.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+import aiohttp
+import psutil
+
+from bench.mock_api import start_mock, add_mock_args, mock_config
+import func.state as state
+import func.afk as afk
+
+
+def _pct(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def _summary_ms(values: list) -> dict:
+    return {
+        "p50": round(_pct(values, 0.50) * 1000, 2),
+        "p99": round(_pct(values, 0.99) * 1000, 2),
+        "max": round(max(values, default=0.0) * 1000, 2),
+        "count": len(values),
+    }
+
+
+def _hb_tracer(latencies: list) -> aiohttp.TraceConfig:
+    """Đo độ trễ phía client của từng request heartbeat trên client HTTP dùng chung."""
+    tc = aiohttp.TraceConfig()
+
+    async def on_start(session, ctx, params):
+        ctx.t0 = time.perf_counter()
+
+    async def on_end(session, ctx, params):
+        if params.url.path.endswith("/heartbeat"):
+            latencies.append(time.perf_counter() - ctx.t0)
+
+    tc.on_request_start.append(on_start)
+    tc.on_request_end.append(on_end)
+    return tc
+
+
+async def _loop_lag(samples: list, interval: float = 0.1):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(time.perf_counter() - t0 - interval, 0.0))
+
+
+async def _mock_call(base: str, method: str, path: str) -> dict:
+    async with state.get_http().request(method, f"{base}{path}") as r:
+        return await r.json()
+
+
+async def _wait_farming(n: int, timeout: float) -> float:
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if sum(1 for s in state.sessions.values() if s.afk_status == "farming") >= n:
+            return time.monotonic() - t0
+        await asyncio.sleep(0.2)
+    return -1.0
+
+
+async def run_size(n: int, args, base: str, latencies: list, workdir: str) -> dict:
+    proc = psutil.Process()
+
+    await state.db_close()
+    state.DB_PATH = os.path.join(workdir, f"bench-{n}.db")
+    await state.db_init()
+    for i in range(n):
+        token = f"Bearer bench-{n:05d}-{i:06d}-{os.urandom(6).hex()}"
+        await state.db_save_token(state.short(token), token, "stale", time.time())
+
+    rss0 = proc.memory_info().rss
+    t0 = time.monotonic()
+    await afk.load_all_tokens()
+    boot_secs = time.monotonic() - t0
+    farming_secs = await _wait_farming(n, timeout=max(60.0, n / 10))
+    rss1 = proc.memory_info().rss
+
+    await _mock_call(base, "POST", "/_reset")
+    latencies.clear()
+    lag: list = []
+    lag_task = asyncio.create_task(_loop_lag(lag))
+    cpu0 = proc.cpu_times()
+    t0 = time.monotonic()
+    await asyncio.sleep(args.duration)
+    elapsed = time.monotonic() - t0
+    cpu1 = proc.cpu_times()
+    lag_task.cancel()
+    mock = await _mock_call(base, "GET", "/_stats")
+
+    for key in list(state.sessions):
+        await state.remove_session(key)
+
+    gaps     = mock["hb_gaps"]
+    tol      = afk.HB_INTERVAL * (1 + args.ontime_tol)
+    total_rq = sum(mock["requests"].values())
+    return {
+        "sessions": n,
+        "boot_secs": round(boot_secs, 3),
+        "time_to_all_farming_secs": round(boot_secs + farming_secs, 3) if farming_secs >= 0 else None,
+        "requests_per_sec": round(total_rq / elapsed, 2),
+        "requests": mock["requests"],
+        "statuses": mock["statuses"],
+        "hb_on_time_pct": round(sum(1 for g in gaps if g <= tol) / len(gaps) * 100, 2) if gaps else None,
+        "hb_latency_ms": _summary_ms(latencies),
+        "rss_per_session_kb": round((rss1 - rss0) / n / 1024, 2),
+        "cpu_secs": round((cpu1.user + cpu1.system) - (cpu0.user + cpu0.system), 3),
+        "loop_lag_ms": _summary_ms(lag),
+    }
+
+
+async def main(args):
+    afk.HB_INTERVAL        = args.hb_interval
+    afk.REST_INTERVAL      = args.duration * 10  # không cho chu kỳ nghỉ xen vào số đo
+    afk.PHASE_SPREAD       = False               # lệch pha sẽ rút ngắn chu kỳ đầu, đưa nghỉ vào giữa lần đo
+    afk.BOOT_ADMIT_RATE    = args.admit_rate
+    afk.SCHED_MAX_INFLIGHT = args.max_inflight
+    state.API_RATE         = args.api_rate   # mặc định tắt: đo farm, không đo bộ giới hạn
+
+    latencies: list = []
+    state.HTTP_TRACE_CONFIGS.append(_hb_tracer(latencies))
+
+    runner = None
+    base = args.mock_url
+    if not base:
+        runner, base = await start_mock(mock_config(args))
+    state.BASE = base
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in args.sizes:
+            print(f"[BENCH] {n} session ...", file=sys.stderr)
+            with contextlib.redirect_stdout(open(os.devnull, "w")):
+                res = await run_size(n, args, base, latencies, workdir)
+                state.flush_console()  # log console in trên luồng riêng — in hết trước khi trả stdout
+            print(f"[BENCH] {n}: {res['requests_per_sec']} req/s, on-time {res['hb_on_time_pct']}%, "
+                  f"HB p99 {res['hb_latency_ms']['p99']}ms, lag p99 {res['loop_lag_ms']['p99']}ms",
+                  file=sys.stderr)
+            results.append(res)
+        await afk.stop_scheduler()
+        await state.close_http()
+        await state.db_close()
+    if runner is not None:
+        await runner.cleanup()
+
+    out = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "runs": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(out, f, indent=2, ensure_ascii=False)
+    print(f"[BENCH] ghi kết quả vào {args.out}", file=sys.stderr)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark farm trên mock Altare API")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10, 100, 1000])
+    p.add_argument("--duration", type=float, default=60.0, help="giây đo mỗi kích thước")
+    p.add_argument("--hb-interval", type=float, default=5.0, help="HB_INTERVAL dùng khi đo")
+    p.add_argument("--admit-rate", type=float, default=200.0, help="BOOT_ADMIT_RATE dùng khi đo")
+    p.add_argument("--api-rate", type=float, default=0.0, help="API_RATE dùng khi đo (0 = không giới hạn)")
+    p.add_argument("--max-inflight", type=int, default=afk.SCHED_MAX_INFLIGHT, help="SCHED_MAX_INFLIGHT dùng khi đo")
+    p.add_argument("--ontime-tol", type=float, default=0.1, help="HB đúng giờ nếu khoảng cách ≤ interval*(1+tol)")
+    p.add_argument("--mock-url", default=None, help="dùng mock chạy sẵn thay vì mock trong process")
+    p.add_argument("--out", default="bench_result.json")
+    add_mock_args(p)
+    return p.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
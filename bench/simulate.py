@@ -0,0 +1,160 @@
+"""Mô phỏng farm bằng đồng hồ ảo — tua nhanh nhiều giờ chu kỳ farm/nghỉ trong vài giây.
+
+    python -m bench.simulate --sessions 300 --hours 24 --out sim.json
+
+Chạy func.afk với HB_INTERVAL/REST_INTERVAL/REST_DURATION thật nhưng trên VirtualEventLoop.
+--transport direct (mặc định) thay các lời gọi API trong func.afk bằng coroutine giả lập
+trong process, nhanh nhất; --transport http dùng mock API qua socket loopback như bench.run.
+Cuối cùng đối chiếu số heartbeat đã gửi với lifetime_stats trong DB để kiểm tra flush stats.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+
+from bench.mock_api import start_mock, add_mock_args, mock_config, MockConfig
+from func import clock
+import func.state as state
+import func.afk as afk
+
+
+def _install_direct_transport(cfg: MockConfig, counts: Counter):
+    """Thay HTTP bằng coroutine giả lập: trễ theo cfg trên đồng hồ ảo, lỗi theo error_rate."""
+
+    async def _call(op: str) -> bool:
+        counts[op] += 1
+        delay = max(cfg.latency_ms + random.uniform(-cfg.jitter_ms, cfg.jitter_ms), 0) / 1000
+        await asyncio.sleep(delay)
+        ok = random.random() >= cfg.error_rate
+        counts[f"{op}_ok" if ok else f"{op}_fail"] += 1
+        return ok
+
+    async def api_post(url: str, token: str, s=None, deadline=None) -> tuple:
+        ok = await _call(url.rsplit("/", 1)[-1])
+        return (True, None) if ok else (False, "HTTP 500: internal")
+
+    async def stop_remote(token: str, tenant_id: str) -> bool:
+        return await _call("stop")
+
+    async def detect_tenant(token: str):
+        await _call("tenants")
+        return ("t-" + token[-12:],)
+
+    afk.api_post      = api_post
+    afk._stop_remote  = stop_remote
+    afk.detect_tenant = detect_tenant
+    state.detect_tenant = detect_tenant
+
+
+async def main(args) -> dict:
+    random.seed(args.seed)
+    afk.HB_LOG_MODE = "session"  # một dòng tóm tắt thay vì mỗi HB một dòng
+    afk.BOOT_ADMIT_RATE = args.admit_rate
+    afk.STATS_FLUSH_INTERVAL = args.flush_interval
+
+    counts: Counter = Counter()
+    runner = None
+    if args.transport == "direct":
+        _install_direct_transport(mock_config(args), counts)
+    else:
+        runner, state.BASE = await start_mock(mock_config(args))
+
+    workdir = tempfile.mkdtemp(prefix="altare-sim-")
+    state.DB_PATH = os.path.join(workdir, "sim.db")
+    await state.db_init()
+    for i in range(args.sessions):
+        token = f"Bearer sim-{i:06d}-{random.getrandbits(48):012x}"
+        await state.db_save_token(state.short(token), token, "t-" + token[-12:], clock.now(), clock.now())
+
+    real0 = time.perf_counter()
+    virt0 = clock.monotonic()
+    afk.start_stats_flusher()
+    await afk.load_all_tokens()
+    await asyncio.sleep(args.hours * 3600 - (clock.monotonic() - virt0))
+    virt_secs = clock.monotonic() - virt0
+
+    for key in list(state.sessions):
+        await afk.stop_afk_session(key)
+    await afk.stop_stats_flusher()  # lần flush cuối
+    await afk.stop_scheduler()
+    real_secs = time.perf_counter() - real0
+
+    rows = await state._db_run(lambda c: c.execute(
+        "SELECT SUM(total_hb_ok), SUM(total_hb_fail), SUM(total_uptime_secs) FROM lifetime_stats"
+    ).fetchone())
+    db_ok, db_fail, db_uptime = (v or 0 for v in rows)
+
+    if runner is not None:
+        mock = await (await state.get_http().get(f"{state.BASE}/_stats")).json()
+        counts.update(mock["requests"])
+        hb_sent = mock["requests"].get("heartbeat", 0)
+        await runner.cleanup()
+    else:
+        hb_sent = counts["heartbeat"]
+    await state.close_http()
+    await state.db_close()
+
+    cycles = [s.cycle for s in state.sessions.values()]
+    return {
+        "sessions": args.sessions,
+        "transport": args.transport,
+        "virtual_hours": round(virt_secs / 3600, 3),
+        "real_secs": round(real_secs, 2),
+        "speedup": round(virt_secs / real_secs, 1) if real_secs else None,
+        "requests": dict(counts),
+        "heartbeats_per_session_hour": round(hb_sent / args.sessions / (virt_secs / 3600), 2),
+        "cycles_avg": round(sum(cycles) / len(cycles), 2) if cycles else 0,
+        "scheduler": afk.scheduler_stats(),
+        "stats_flush": {
+            "heartbeats_sent": hb_sent,
+            "db_hb_ok": db_ok,
+            "db_hb_fail": db_fail,
+            "unaccounted": hb_sent - db_ok - db_fail,
+            "db_uptime_hours_per_session": round(db_uptime / args.sessions / 3600, 3),
+        },
+        "db_path": state.DB_PATH,
+    }
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Mô phỏng farm trên đồng hồ ảo")
+    p.add_argument("--sessions", type=int, default=300)
+    p.add_argument("--hours", type=float, default=24.0, help="số giờ ảo cần mô phỏng")
+    p.add_argument("--transport", choices=("direct", "http"), default="direct")
+    p.add_argument("--admit-rate", type=float, default=afk.BOOT_ADMIT_RATE)
+    p.add_argument("--flush-interval", type=float, default=afk.STATS_FLUSH_INTERVAL)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", default=None, help="ghi kết quả JSON vào file")
+    add_mock_args(p)
+    return p.parse_args(argv)
+
+
+def run(args) -> dict:
+    loop = clock.VirtualEventLoop()
+    clock.use_loop_clock(loop)
+    asyncio.set_event_loop(loop)
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            try:
+                return loop.run_until_complete(main(args))
+            finally:
+                state.flush_console()  # log console in trên luồng riêng — in hết trước khi trả stdout
+    finally:
+        loop.close()
+        clock.use_real_clock()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text, file=sys.stderr if args.out else sys.stdout)
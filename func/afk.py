@@ -1,257 +1,712 @@
+import os
+import math
+import zlib
+import heapq
+import random
 import asyncio
-import aiohttp
-import time
-from datetime import datetime
+import itertools
+from func import clock
 from func.state import (
-    sessions, lock, make_headers, api_post, add_log, BASE,
-    db_update_lifetime, db_save_token,
-    new_session, detect_tenant,
+    sessions, api_post, add_log, add_farm_log, afk_url,
+    db_update_lifetime_many, db_save_token, db_save_tokens_many, short,
+    db_save_checkpoints, db_take_checkpoints, db_compact_series,
+    Session, new_session, add_session, detect_tenant,
+    db_set_tenant, tenant_fresh, is_tenant_error, refresh_tenant, observe_drift,
+    metrics, counters, breaker_wait, BREAKER_RAMP, CIRCUIT_OPEN_ERR, RATE_LIMITED_ERR, set_status, console_print,
 )
 
 HB_INTERVAL   = 30    # giây giữa các heartbeat
 REST_INTERVAL = 3600  # farm bao nhiêu giây thì nghỉ (1 giờ)
 REST_DURATION = 60    # nghỉ bao nhiêu giây rồi chạy lại
-STAGGER_STEP  = 3     # giây cách nhau khi boot nhiều token
 
+# Rải thời điểm nghỉ của các session đều trong REST_INTERVAL: chu kỳ đầu của mỗi session ngắn đi
+# một khoảng lệch cố định theo crc32(short), các chu kỳ sau giữ nguyên độ dài.
+PHASE_SPREAD = os.getenv("PHASE_SPREAD", "1") != "0"
+START_CONFLICT_STATUS = ("HTTP 409",)  # start bị từ chối vì phía Altare còn phiên cũ
 
-async def _stop_remote(http: aiohttp.ClientSession, token: str, tenant_id: str):
+HB_DEADLINE_SLACK = 1.0  # HB (kể cả retry) phải xong trước lượt kế tiếp ít nhất chừng này giây
+
+BOOT_CONCURRENCY = int(os.getenv("BOOT_CONCURRENCY", "10"))     # số detect_tenant chạy song song lúc boot
+BOOT_ADMIT_RATE  = float(os.getenv("BOOT_ADMIT_RATE", "5"))     # số session nạp vào scheduler mỗi giây
+BOOT_REPORT_WAIT = float(os.getenv("BOOT_REPORT_WAIT", "120"))  # nạp xong mà sau chừng này giây chưa đủ farm thì vẫn báo
+
+SCHED_MAX_INFLIGHT   = int(os.getenv("SCHED_MAX_INFLIGHT", "10000"))  # trần số job (start/heartbeat) đang chạy cùng lúc
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "60"))  # giây giữa các lần ghi lifetime stats
+SERIES_COMPACT_INTERVAL = int(os.getenv("SERIES_COMPACT_INTERVAL", "600"))  # giây giữa các lần gộp hb_series
+
+# Khởi động lại nhanh: khi tắt êm, chờ job đang chạy xong rồi lưu checkpoint từng session;
+# lúc boot, session đang farm và checkpoint chưa quá CHECKPOINT_MAX_AGE giây thì gửi heartbeat
+# luôn thay vì stop -> start. HB đầu tiên lỗi thì quay về stop -> start như bình thường.
+SHUTDOWN_DRAIN     = float(os.getenv("SHUTDOWN_DRAIN", "10"))
+CHECKPOINT_MAX_AGE = float(os.getenv("CHECKPOINT_MAX_AGE", "120"))
+
+# Log heartbeat: "each" = mỗi HB một dòng (lấy mẫu 1/HB_LOG_SAMPLE),
+# "session" = mỗi HB_LOG_SUMMARY_MIN phút một dòng tóm tắt mỗi session, "farm" = một dòng cho cả farm.
+# HB lỗi và chuyển trạng thái luôn được log ngay.
+HB_LOG_MODE        = os.getenv("HB_LOG_MODE", "each").lower()
+HB_LOG_SAMPLE      = max(int(os.getenv("HB_LOG_SAMPLE", "1")), 1)
+HB_LOG_SUMMARY_MIN = float(os.getenv("HB_LOG_SUMMARY_MIN", "5"))
+
+_boot = {"t0": 0.0, "total": 0, "reported": False}
+_boot_pending: set = set()  # token boot chưa vào farming lần nào
+_boot_task: asyncio.Task = None
+
+_stats_task: asyncio.Task = None
+_summary_task: asyncio.Task = None
+_series_task: asyncio.Task = None
+
+
+async def _stop_remote(token: str, tenant_id: str):
+    ok, _ = await api_post(afk_url(tenant_id, "stop"), token)
+    return ok
+
+
+# --- Bộ lập lịch trung tâm ---
+# Mỗi session chỉ có tối đa một mục trong heap: (thời điểm đến hạn, seq, short, gen, action).
+# Dispatcher tạo một task cho mỗi mục đến hạn; job chờ I/O không giữ chỗ của job khác,
+# SCHED_MAX_INFLIGHT chỉ là trần bộ nhớ. gen tăng mỗi lần start/stop session, mục mang gen cũ bị bỏ qua.
+
+_heap: list = []
+_seq = itertools.count()
+_wake: asyncio.Event = None
+_slots: asyncio.Semaphore = None
+_dispatch_task: asyncio.Task = None
+_job_tasks: set = set()
+_sched = {"fired": 0, "running": 0, "late_last": 0.0, "late_max": 0.0, "late_avg": 0.0}
+
+
+def _schedule(short: str, gen: int, action: str, delay: float = 0.0, due: float = None):
+    if due is None:
+        due = clock.monotonic() + delay
+    heapq.heappush(_heap, (due, next(_seq), short, gen, action))
+    if _wake is not None and _heap[0][2] == short:
+        _wake.set()
+
+
+def _live(short: str, gen: int):
+    """Session còn chạy và job vẫn thuộc thế hệ hiện tại thì trả về session, ngược lại None."""
+    s = sessions.get(short)
+    if s is None or not s.afk_running or s.gen != gen:
+        return None
+    return s
+
+
+async def _dispatcher():
+    while True:
+        if not _heap:
+            _wake.clear()
+            await _wake.wait()
+            continue
+        delay = _heap[0][0] - clock.monotonic()
+        if delay > 0:
+            _wake.clear()
+            try:
+                await asyncio.wait_for(_wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        due, _, short, gen, action = heapq.heappop(_heap)
+        if _live(short, gen) is None:
+            continue
+        await _slots.acquire()  # chỉ chờ khi đã chạm trần SCHED_MAX_INFLIGHT
+        tk = asyncio.create_task(_run_job(due, short, gen, action))
+        _job_tasks.add(tk)
+        tk.add_done_callback(_job_tasks.discard)
+
+
+async def _run_job(due: float, short: str, gen: int, action: str):
+    late = max(clock.monotonic() - due, 0.0)
+    _sched["fired"]    += 1
+    _sched["late_last"] = late
+    _sched["late_max"]  = max(_sched["late_max"], late)
+    _sched["late_avg"]  = late if _sched["fired"] == 1 else _sched["late_avg"] * 0.95 + late * 0.05
+    _sched["running"]  += 1
     try:
-        async with http.post(
-            f"{BASE}/api/tenants/{tenant_id}/rewards/afk/stop",
-            headers=make_headers(token), json={},
-            timeout=aiohttp.ClientTimeout(total=12),
-        ) as r:
-            return r.status in (200, 201, 204)
-    except Exception:
+        await _JOBS[action](short, gen, due)
+    except Exception as e:
+        console_print(f"[SCHED] job {action} ...{short[-8:]} lỗi: {e}")
+    finally:
+        _sched["running"] -= 1
+        _slots.release()
+
+
+def start_scheduler():
+    global _wake, _slots, _dispatch_task
+    if _dispatch_task is not None:
+        return
+    _wake  = asyncio.Event()
+    _slots = asyncio.Semaphore(SCHED_MAX_INFLIGHT)
+    _dispatch_task = asyncio.create_task(_dispatcher())
+    if _heap:
+        _wake.set()
+
+
+async def stop_scheduler(drain: float = 0.0):
+    """Dừng scheduler. drain > 0: ngừng phát job mới, chờ tối đa drain giây cho job đang chạy xong."""
+    global _dispatch_task
+    if _dispatch_task is None:
+        return
+    _dispatch_task.cancel()
+    if drain > 0:
+        end = clock.monotonic() + drain
+        while _job_tasks and clock.monotonic() < end:
+            await asyncio.sleep(0.1)
+    tasks = [_dispatch_task, *_job_tasks]
+    for tk in tasks:
+        tk.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _dispatch_task = None
+
+
+def scheduler_stats() -> dict:
+    return {
+        "pending":   len(_heap),
+        "queued":    int(_slots is not None and _slots.locked()),  # dispatcher đang chờ chỗ trống
+        "running":   _sched["running"],
+        "fired":     _sched["fired"],
+        "late_last": _sched["late_last"],
+        "late_avg":  _sched["late_avg"],
+        "late_max":  _sched["late_max"],
+    }
+
+
+# --- Các bước của một chu kỳ farm: stop -> start -> hb ... hb -> rest -> stop ... ---
+
+def _hold(short: str, gen: int, action: str, err: str = None) -> bool:
+    """API đang ngắt mạch: hoãn job tới lúc được thử lại, không tính là lỗi. Trả True nếu đã hoãn."""
+    if err is not None and err != CIRCUIT_OPEN_ERR:
+        return False
+    wait = breaker_wait()
+    if err is None and wait <= 0:
         return False
+    # thả lại trong BREAKER_RAMP giây sau lúc mở với mật độ tăng tuyến tính (độ trễ ~ RAMP·√u):
+    # lượng request tăng dần kể cả khi không bật API_RATE, không dồn cục ngay khi API vừa hồi
+    _schedule(short, gen, action, wait + BREAKER_RAMP * math.sqrt(random.random()))
+    return True
 
 
-async def _try_start(http: aiohttp.ClientSession, token: str, tenant_id: str, short: str) -> bool:
-    """Retry start vô hạn đến khi thành công. Trả False nếu bị dừng bởi người dùng."""
-    afk_base = f"{BASE}/api/tenants/{tenant_id}/rewards/afk"
-    attempt  = 0
+async def _job_stop(short: str, gen: int, due: float):
+    s = _live(short, gen)
+    if s is None or _hold(short, gen, "stop"):
+        return
+    counters["stop_sent"] += 1
+    if await _stop_remote(s.token, s.tenant_id):
+        s.remote = "stopped"
+    _schedule(short, gen, "start", 2)
 
-    while True:
-        async with lock:
-            if short not in sessions or not sessions[short]["afk_running"]:
-                return False
 
-        await _stop_remote(http, token, tenant_id)
-        await asyncio.sleep(2)
+async def _job_start(short: str, gen: int, due: float):
+    s = _live(short, gen)
+    if s is None or _hold(short, gen, "start"):
+        return
+    ok, err = await api_post(afk_url(s.tenant_id, "start"), s.token, s)
+    if not ok and _hold(short, gen, "start", err):
+        return
+    if err == RATE_LIMITED_ERR:
+        _schedule(short, gen, "start", random.uniform(1, 5))  # chưa gửi được — thử lại, không tính lần lỗi
+        return
 
-        async with lock:
-            if short not in sessions or not sessions[short]["afk_running"]:
-                return False
+    if not ok and is_tenant_error(err):
+        await refresh_tenant(s)  # lần thử sau dùng tenant mới nếu có
 
-        ok, err = await api_post(http, f"{afk_base}/start", token)
+    s = _live(short, gen)
+    if s is None:
+        return
+    async with s.lock:
+        if not ok:
+            s.start_attempt += 1
+            wait = min(15 * s.start_attempt, 120)
+            if _is_conflict(err):
+                counters["start_conflict"] += 1
+            s.remote = "unknown"  # không rõ Altare trả lỗi gì khi phiên cũ còn chạy — lần sau stop trước
+            add_log(s, f"start lần {s.start_attempt} thất bại: {err} — thử lại sau {wait}s", "warn")
+            _schedule(short, gen, _start_action(s), wait)
+            return
+        s.remote        = "running"
+        s.start_attempt = 0
+        s.hb_count      = 0
+        set_status(s, "farming")
+        s.afk_error     = None
+        s.farm_start    = clock.now()
+        add_log(s, f"farming chu kỳ {s.cycle}", "success")
+    _boot_farming(short)
+    _schedule(short, gen, "hb", HB_INTERVAL)
+
+
+async def _job_hb(short: str, gen: int, due: float):
+    s = _live(short, gen)
+    if s is None:
+        return
+    if _hold(short, gen, "hb"):
+        set_status(s, "paused")
+        return
+    now = clock.monotonic()
+    observe_drift(s, max(now - due, 0.0))
+    # retry không được lấn sang lượt HB kế tiếp; job chạy trễ vẫn có đủ một nhịp để thử
+    ok, err = await api_post(afk_url(s.tenant_id, "heartbeat"), s.token, s,
+                             deadline=max(due, now) + HB_INTERVAL - HB_DEADLINE_SLACK)
+    if not ok and _hold(short, gen, "hb", err):
+        set_status(s, "paused")
+        return
+    if err == RATE_LIMITED_ERR:
+        # HB không được gửi vì API_RATE — bỏ lượt này, không tính là HB lỗi
+        _schedule(short, gen, "hb", due=max(due + HB_INTERVAL, clock.monotonic()))
+        return
 
+    s = _live(short, gen)
+    if s is None:
+        return
+    if s.resumed:
+        s.resumed = False
+        if not ok:
+            add_log(s, f"không tiếp tục được sau khởi động lại ({err}) — start lại từ đầu", "warn")
+            set_status(s, "starting")
+            s.remote     = "unknown"
+            _schedule(short, gen, "stop")
+            return
+        _boot_farming(short)
+    async with s.lock:
+        s.hb_count += 1
+        counters["hb_ok" if ok else "hb_fail"] += 1
         if ok:
-            return True
+            s.hb_ok     += 1
+            s.hb_last    = clock.now_dt().strftime("%H:%M:%S")
+            set_status(s, "farming")
+            s.afk_error  = None
+            if HB_LOG_MODE == "each":
+                if s.hb_count % HB_LOG_SAMPLE == 0:
+                    add_log(s, f"HB #{s.hb_count} ok ({s.hb_ok} tổng)", "success")
+            else:
+                s.win_ok += 1
+        else:
+            s.hb_fail   += 1
+            s.win_fail  += HB_LOG_MODE != "each"
+            s.afk_error  = err
+            add_log(s, f"HB #{s.hb_count} thất bại: {err}", "error")
+
+        if clock.now() - s.cycle_start >= REST_INTERVAL:
+            # hết chu kỳ, chuyển sang nghỉ; không gửi HB trong lúc nghỉ nên phiên phía Altare hết hạn
+            set_status(s, "resting")
+            s.remote     = "idle"
+            s.afk_error  = None
+            add_log(s, f"nghỉ {REST_DURATION}s sau chu kỳ {s.cycle}", "info")
+            _schedule(short, gen, "resume", REST_DURATION)
+            return
+
+    if not ok and is_tenant_error(err) and await refresh_tenant(s):
+        # tenant đã đổi — start lại trên tenant mới
+        set_status(s, "starting")
+        s.remote     = "unknown"
+        _schedule(short, gen, "stop")
+        return
+    # giữ nhịp theo thời điểm đến hạn, không trôi theo độ trễ request
+    _schedule(short, gen, "hb", due=max(due + HB_INTERVAL, clock.monotonic()))
 
-        attempt += 1
-        wait = min(15 * attempt, 120)
-        async with lock:
-            if short in sessions:
-                add_log(sessions[short],
-                        f"start lần {attempt} thất bại: {err} — thử lại sau {wait}s", "warn")
-        await asyncio.sleep(wait)
 
+async def _job_resume(short: str, gen: int, due: float):
+    s = _live(short, gen)
+    if s is None:
+        return
+    async with s.lock:
+        _reset_counters(s)
+        s.farm_start   = None
+        s.cycle       += 1
+        s.cycle_start  = clock.now()
+        set_status(s, "starting")
+        add_log(s, f"bắt đầu chu kỳ {s.cycle}", "info")
+    _schedule(short, gen, _start_action(s))
+
+
+def _is_conflict(err: str) -> bool:
+    return bool(err) and err.startswith(START_CONFLICT_STATUS)
+
+
+def _start_action(s: Session) -> str:
+    """Chỉ gọi stop khi không chắc phía Altare đang ở trạng thái nào; đã dừng/hết hạn thì start luôn."""
+    if s.remote in ("stopped", "idle"):
+        counters["stop_skipped"] += 1
+        return "start"
+    return "stop"
+
+
+def _phase(short: str) -> float:
+    """Độ lệch cố định trong [0, REST_INTERVAL) theo key, để các session không nghỉ cùng lúc."""
+    if not PHASE_SPREAD:
+        return 0.0
+    return zlib.crc32(short.encode()) / 2 ** 32 * REST_INTERVAL
+
+
+_JOBS = {
+    "stop":   _job_stop,
+    "start":  _job_start,
+    "hb":     _job_hb,
+    "resume": _job_resume,
+}
+
+
+def _reset_counters(s: Session):
+    """Đưa bộ đếm chu kỳ về 0 nhưng giữ lại phần delta chưa ghi DB."""
+    s.last_hb_ok   -= s.hb_ok
+    s.last_hb_fail -= s.hb_fail
+    s.hb_ok         = 0
+    s.hb_fail       = 0
+
+
+async def flush_stats():
+    """Gom delta stats của mọi session và ghi một lần bằng executemany."""
+    rows = []
+    now  = clock.now()
+    # đoạn này không có await nên đọc/ghi từng session là nguyên tử, không cần khóa
+    for key, s in list(sessions.items()):
+        hb_ok_d   = s.hb_ok   - s.last_hb_ok
+        hb_fail_d = s.hb_fail - s.last_hb_fail
+        if s.afk_status == "farming":
+            s.uptime_pending += now - s.farm_mark
+            s.farm_mark       = now
+        uptime_d = int(s.uptime_pending)
+        if hb_ok_d <= 0 and hb_fail_d <= 0 and uptime_d <= 0:
+            continue
+        s.last_hb_ok      = s.hb_ok
+        s.last_hb_fail    = s.hb_fail
+        s.uptime_pending -= uptime_d  # phần lẻ giây để lần sau
+        rows.append((key, hb_ok_d, hb_fail_d, uptime_d))
 
-async def _worker(short: str):
-    cycle = 0
+    if not rows:
+        return
+    t0 = clock.monotonic()
+    try:
+        await db_update_lifetime_many(rows)
+        metrics["db_flush"].observe(clock.monotonic() - t0)
+        counters["db_flush_rows"] += len(rows)
+    except Exception as e:
+        counters["db_flush_errors"] += 1
+        console_print(f"[STATS] lỗi ghi {len(rows)} session: {e}")
+        # trả delta lại để lần flush sau ghi tiếp
+        for key, hb_ok_d, hb_fail_d, uptime_d in rows:
+            if key in sessions:
+                sessions[key].last_hb_ok     -= hb_ok_d
+                sessions[key].last_hb_fail   -= hb_fail_d
+                sessions[key].uptime_pending += uptime_d
+
+
+async def _stats_flusher():
+    try:
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            await flush_stats()
+    except asyncio.CancelledError:
+        await flush_stats()  # lần ghi cuối khi tắt
+        raise
 
+
+async def _hb_summary_loop():
+    """Chế độ gộp log: định kỳ tóm tắt số heartbeat thay cho một dòng mỗi HB."""
     while True:
-        async with lock:
-            if short not in sessions or not sessions[short]["afk_running"]:
-                return
-            s         = sessions[short]
-            token     = s["token"]
-            tenant_id = s["tenant_id"]
-            s["afk_status"] = "starting"
-
-        afk_base    = f"{BASE}/api/tenants/{tenant_id}/rewards/afk"
-        cycle_start = time.time()
-        cycle      += 1
-
-        async with aiohttp.ClientSession() as http:
-            started = await _try_start(http, token, tenant_id, short)
-            if not started:
-                return  # dừng bởi người dùng
-
-            async with lock:
-                if short not in sessions:
-                    return
-                s = sessions[short]
-                s["afk_status"] = "farming"
-                s["afk_error"]  = None
-                s["farm_start"] = time.time()
-                add_log(s, f"farming chu kỳ {cycle}", "success")
-
-            hb_count = 0
-
-            while True:
-                await asyncio.sleep(HB_INTERVAL)
-
-                async with lock:
-                    if short not in sessions or not sessions[short]["afk_running"]:
-                        return
-
-                hb_count += 1
-                ok, err = await api_post(http, f"{afk_base}/heartbeat", token)
-
-                async with lock:
-                    if short not in sessions or not sessions[short]["afk_running"]:
-                        return
-                    s = sessions[short]
-
-                    if ok:
-                        s["hb_ok"]     += 1
-                        s["hb_last"]    = datetime.now().strftime("%H:%M:%S")
-                        s["afk_status"] = "farming"
-                        s["afk_error"]  = None
-                        add_log(s, f"HB #{hb_count} ok ({s['hb_ok']} tổng)", "success")
-                    else:
-                        s["hb_fail"]   += 1
-                        s["afk_error"]  = err
-                        add_log(s, f"HB #{hb_count} thất bại: {err}", "error")
-
-                if time.time() - cycle_start >= REST_INTERVAL:
-                    break  # hết chu kỳ, chuyển sang nghỉ
-
-        # --- Nghỉ định kỳ ---
-        async with lock:
-            if short not in sessions or not sessions[short]["afk_running"]:
-                return
-            s = sessions[short]
-            s["afk_status"] = "resting"
-            s["afk_error"]  = None
-            add_log(s, f"nghỉ {REST_DURATION}s sau chu kỳ {cycle}", "info")
-
-        await asyncio.sleep(REST_DURATION)
-
-        async with lock:
-            if short not in sessions or not sessions[short]["afk_running"]:
-                return
-            s = sessions[short]
-            s["hb_ok"]         = 0
-            s["hb_fail"]       = 0
-            s["farm_start"]    = None
-            s["_last_hb_ok"]   = 0
-            s["_last_hb_fail"] = 0
-            s["_last_stat_ts"] = time.time()
-            add_log(s, f"bắt đầu chu kỳ {cycle + 1}", "info")
-
-
-async def _stats_worker(short: str):
-    while True:
-        await asyncio.sleep(60)
-        async with lock:
-            if short not in sessions:
-                return
-            s = sessions[short]
-            if not s["afk_running"]:
+        await asyncio.sleep(HB_LOG_SUMMARY_MIN * 60)
+        total_ok = total_fail = active = 0
+        for s in list(sessions.values()):
+            if not s.win_ok and not s.win_fail:
                 continue
-            now       = time.time()
-            hb_ok_d   = s["hb_ok"]  - s.get("_last_hb_ok",  0)
-            hb_fail_d = s["hb_fail"] - s.get("_last_hb_fail", 0)
-            uptime_d  = int(now      - s.get("_last_stat_ts", now))
-            s["_last_hb_ok"]   = s["hb_ok"]
-            s["_last_hb_fail"] = s["hb_fail"]
-            s["_last_stat_ts"] = now
-
-        if hb_ok_d > 0 or hb_fail_d > 0:
-            try:
-                db_update_lifetime(short, hb_ok_d, hb_fail_d, uptime_d)
-            except Exception as e:
-                async with lock:
-                    if short in sessions:
-                        add_log(sessions[short], f"lỗi ghi stats: {e}", "error")
+            if HB_LOG_MODE == "session":
+                add_log(s, f"{s.win_ok} HB ok, {s.win_fail} lỗi trong {HB_LOG_SUMMARY_MIN:g} phút "
+                           f"({s.hb_ok} tổng chu kỳ)", "success")
+            total_ok   += s.win_ok
+            total_fail += s.win_fail
+            active     += 1
+            s.win_ok = s.win_fail = 0
+        if HB_LOG_MODE == "farm" and active:
+            add_farm_log(f"{active} session: {total_ok} HB ok, {total_fail} lỗi "
+                         f"trong {HB_LOG_SUMMARY_MIN:g} phút", "success")
+
+
+async def _series_compactor():
+    """Gộp hb_series định kỳ. Chỉ một process làm việc này (shard 0 khi chạy nhiều process)."""
+    while True:
+        try:
+            await db_compact_series()
+        except Exception as e:
+            console_print(f"[SERIES] lỗi gộp: {e}")
+        await asyncio.sleep(SERIES_COMPACT_INTERVAL)
+
+
+def start_stats_flusher():
+    global _stats_task, _summary_task, _series_task
+    from func.state import SHARD_INDEX
+    if _stats_task is None or _stats_task.done():
+        _stats_task = asyncio.create_task(_stats_flusher())
+    if HB_LOG_MODE != "each" and (_summary_task is None or _summary_task.done()):
+        _summary_task = asyncio.create_task(_hb_summary_loop())
+    if SHARD_INDEX == 0 and (_series_task is None or _series_task.done()):
+        _series_task = asyncio.create_task(_series_compactor())
+
+
+async def stop_stats_flusher():
+    """Dừng flusher và chờ lần ghi cuối hoàn tất."""
+    global _stats_task
+    for tk in (_summary_task, _series_task, _boot_task):
+        if tk is not None:
+            tk.cancel()
+    if _stats_task is not None and not _stats_task.done():
+        _stats_task.cancel()
+        try:
+            await _stats_task
+        except asyncio.CancelledError:
+            pass
+    _stats_task = None
 
 
 async def start_afk_session(short: str):
-    async with lock:
-        if short not in sessions:
-            return
-        s = sessions[short]
-
-        for attr in ("afk_task", "afk_stats_task"):
-            tk = s.get(attr)
-            if tk and not tk.done():
-                tk.cancel()
-
-        s.update({
-            "afk_running":   True,
-            "afk_status":    "starting",
-            "hb_ok":         0,
-            "hb_fail":       0,
-            "afk_error":     None,
-            "farm_start":    None,
-            "_last_hb_ok":   0,
-            "_last_hb_fail": 0,
-            "_last_stat_ts": time.time(),
-        })
-        add_log(s, f"khởi động (tenant: {s['tenant_id']})", "info")
-
-        s["afk_task"]       = asyncio.create_task(_worker(short))
-        s["afk_stats_task"] = asyncio.create_task(_stats_worker(short))
+    s = sessions.get(short)
+    if s is None:
+        return
+    async with s.lock:
+        _reset_counters(s)
+        s.afk_running   = True
+        set_status(s, "starting")
+        s.afk_error     = None
+        s.farm_start    = None
+        s.gen          += 1  # bỏ mọi job còn treo của lần chạy trước
+        s.cycle         = 1
+        s.cycle_start   = clock.now() - _phase(short)
+        s.start_attempt = 0
+        s.resumed       = False
+        s.remote        = "unknown"  # có thể còn phiên cũ (restart, boot lại) — stop trước
+        add_log(s, f"khởi động (tenant: {s.tenant_id})", "info")
+
+    start_scheduler()
+    _schedule(short, s.gen, "stop")
+
+
+async def resume_afk_session(short: str, cp) -> None:
+    """Khôi phục session từ checkpoint và gửi heartbeat ngay, bỏ qua stop -> start."""
+    s = sessions.get(short)
+    if s is None:
+        return
+    async with s.lock:
+        s.afk_running   = True
+        set_status(s, "farming")
+        s.afk_error     = None
+        s.farm_start    = cp["farm_start"]
+        s.cycle         = cp["cycle"]
+        s.cycle_start   = cp["cycle_start"]
+        s.hb_ok         = s.last_hb_ok   = cp["hb_ok"]  # đã ghi vào lifetime lúc tắt
+        s.hb_fail       = s.last_hb_fail = cp["hb_fail"]
+        s.hb_count      = cp["hb_count"]
+        s.gen          += 1
+        s.start_attempt = 0
+        s.resumed       = True
+        s.remote        = "running"
+        add_log(s, f"tiếp tục chu kỳ {s.cycle} sau khởi động lại", "info")
+
+    start_scheduler()
+    _schedule(short, s.gen, "hb")
+
+
+def _resumable(cp, tenant_id: str) -> bool:
+    now = clock.now()
+    return (
+        cp is not None
+        and cp["status"] == "farming"
+        and cp["tenant_id"] == tenant_id
+        and now - cp["saved_at"] <= CHECKPOINT_MAX_AGE
+        and cp["cycle_start"] is not None and now - cp["cycle_start"] < REST_INTERVAL
+    )
+
+
+async def checkpoint_sessions():
+    """Lưu trạng thái chu kỳ của mọi session đang chạy. Gọi sau stop_scheduler và lần flush stats cuối."""
+    now  = clock.now()
+    rows = [
+        (s.short, s.tenant_id, s.afk_status, s.cycle, s.cycle_start, s.farm_start,
+         s.hb_ok, s.hb_fail, s.hb_count, now)
+        for s in list(sessions.values()) if s.afk_running
+    ]
+    if rows:
+        await db_save_checkpoints(rows)
+        console_print(f"[CHECKPOINT] Đã lưu {len(rows)} session")
 
 
 async def stop_afk_session(short: str):
-    async with lock:
-        if short not in sessions:
-            return
-        s = sessions[short]
-        s["afk_running"] = False
-        s["afk_status"]  = "stopped"
-
-        for attr in ("afk_task", "afk_stats_task"):
-            tk = s.get(attr)
-            if tk and not tk.done():
-                tk.cancel()
+    s = sessions.get(short)
+    if s is None:
+        return
+    async with s.lock:
+        s.afk_running = False
+        set_status(s, "stopped")
+        s.gen        += 1
 
         add_log(s, "dừng bởi người dùng", "warn")
 
 
+def _boot_report():
+    """In thời gian từ lúc boot tới khi cả farm chạy (một lần mỗi lần boot)."""
+    if _boot["reported"]:
+        return
+    _boot["reported"] = True
+    total   = _boot["total"]
+    elapsed = clock.monotonic() - _boot["t0"]
+    if _boot_pending:
+        console_print(f"[BOOT] {total - len(_boot_pending)}/{total} token đang farm sau {elapsed:.1f}s "
+                      f"({len(_boot_pending)} chưa vào farming)")
+    else:
+        console_print(f"[BOOT] {total} token đều đang farm sau {elapsed:.1f}s")
+    _boot_pending.clear()
+
+
+def _boot_farming(short: str):
+    """Gọi khi session vào farming lần đầu — đo thời gian từ lúc boot tới khi cả farm chạy."""
+    if short not in _boot_pending:
+        return
+    _boot_pending.discard(short)
+    if not _boot_pending:
+        _boot_report()
+
+
+def boot_forget(short: str):
+    """Token bị gỡ (hoặc nạp lỗi) lúc boot: không chờ nó vào farming nữa."""
+    if short not in _boot_pending:
+        return
+    _boot_pending.discard(short)
+    _boot["total"] -= 1
+    if not _boot_pending:
+        _boot_report()
+
+
+async def _boot_report_later():
+    await asyncio.sleep(BOOT_REPORT_WAIT)
+    _boot_report()
+
+
 async def load_all_tokens():
-    from func.state import db_load_tokens
+    """Boot dạng pipeline: đọc DB -> kiểm tra tenant song song có giới hạn -> nạp vào scheduler theo tốc độ.
+
+    Token kiểm tra xong trước được nạp trước, không phải chờ token chậm hoặc lỗi.
+    """
+    global _boot_task
+    from func.state import db_load_tokens, owns_key
 
-    rows = db_load_tokens()
+    rows = [r for r in await db_load_tokens() if r["short"] not in sessions and owns_key(r["short"])]
     if not rows:
-        print("[BOOT] Không có token nào trong DB")
+        console_print("[BOOT] Không có token nào trong DB")
         return
 
-    print(f"[BOOT] Tải {len(rows)} token, stagger {STAGGER_STEP}s/token")
+    stale = sum(1 for r in rows if not tenant_fresh(r["validated_at"]))
+    console_print(f"[BOOT] Tải {len(rows)} token ({stale} cần kiểm tra lại tenant, "
+                  f"{BOOT_CONCURRENCY} song song), nạp {BOOT_ADMIT_RATE:g} session/s")
 
-    async def _load(row, idx: int):
-        await asyncio.sleep(idx * STAGGER_STEP)
-        key       = row["short"]
-        token     = row["token"]
-        tenant_id = row["tenant_id"]
-        try:
-            async with lock:
-                if key in sessions:
-                    return
+    checkpoints = await db_take_checkpoints(r["short"] for r in rows)
+    resumed     = 0
+
+    _boot["t0"]       = clock.monotonic()
+    _boot["total"]    = len(rows)
+    _boot["reported"] = False
+    _boot_pending.clear()
+    _boot_pending.update(r["short"] for r in rows)
+
+    ready: asyncio.Queue = asyncio.Queue()
+    sem = asyncio.Semaphore(BOOT_CONCURRENCY)
 
+    async def _validate(row):
+        token        = row["token"]
+        tenant_id    = row["tenant_id"]
+        validated_at = row["validated_at"]
+        try:
+            if tenant_fresh(validated_at):
+                return  # tenant trong DB còn hạn — nạp ngay, không gọi API
+            async with sem:
+                result = await detect_tenant(token)
+            if result:
+                tenant_id    = result[0]
+                validated_at = clock.now()
+                await db_set_tenant(row["short"], tenant_id, validated_at)
+            else:
+                console_print(f"[BOOT] Không detect được tenant ...{token[-8:]}, dùng tenant cũ: {tenant_id}")
+        except Exception as e:
+            console_print(f"[BOOT] detect_tenant lỗi ...{token[-8:]}: {e}")
+        finally:
+            await ready.put((row, tenant_id, validated_at))
+
+    async def _admit():
+        nonlocal resumed
+        for _ in range(len(rows)):
+            row, tenant_id, validated_at = await ready.get()
+            key, token = row["short"], row["token"]
             try:
-                async with aiohttp.ClientSession() as http:
-                    result = await detect_tenant(http, token)
-                if result:
-                    tenant_id = result[0]
+                s = new_session(token, tenant_id, added_at=row["added_at"], validated_at=validated_at)
+                if not await add_session(s):
+                    boot_forget(key)
+                    continue
+                add_log(s, "tải từ DB", "info")
+                if _resumable(checkpoints.get(key), tenant_id):
+                    await resume_afk_session(key, checkpoints[key])
+                    resumed += 1
                 else:
-                    print(f"[BOOT] Không detect được tenant ...{token[-8:]}, dùng tenant cũ: {tenant_id}")
+                    await start_afk_session(key)
+                console_print(f"[BOOT] OK ...{token[-8:]}")
             except Exception as e:
-                print(f"[BOOT] detect_tenant lỗi ...{token[-8:]}: {e}")
+                boot_forget(key)
+                console_print(f"[BOOT] Lỗi ...{token[-8:]}: {e}")
+            await asyncio.sleep(1 / BOOT_ADMIT_RATE)
 
-            async with lock:
-                if key in sessions:
-                    return
-                s = new_session(token, tenant_id, added_at=row["added_at"])
-                sessions[key] = s
-                add_log(s, "tải từ DB", "info")
+    await asyncio.gather(_admit(), *[_validate(r) for r in rows])
+    console_print(f"[BOOT] Đã nạp {len(rows)} token vào scheduler sau {clock.monotonic() - _boot['t0']:.1f}s "
+                  f"({resumed} tiếp tục từ checkpoint)")
+    # Token hết hạn không bao giờ vào farming — quá BOOT_REPORT_WAIT thì báo N/M thay vì im lặng
+    if _boot_pending:
+        _boot_task = asyncio.create_task(_boot_report_later())
 
-            await start_afk_session(key)
-            print(f"[BOOT] OK ...{token[-8:]}")
-        except Exception as e:
-            print(f"[BOOT] Lỗi ...{token[-8:]}: {e}")
 
-    await asyncio.gather(*[_load(row, i) for i, row in enumerate(rows)])
+def new_import_progress(lines: int) -> dict:
+    return {"lines": lines, "dup": 0, "checked": 0, "invalid": 0, "saved": 0, "started": 0,
+            "to_check": 0, "done": False, "error": None}
+
+
+async def import_tokens(tokens: list, by: str, progress: dict):
+    """Nhập hàng loạt: lọc trùng -> detect tenant song song có giới hạn -> ghi DB một transaction
+    -> nạp vào scheduler theo BOOT_ADMIT_RATE. Tiến độ cập nhật vào progress."""
+    try:
+        seen, fresh = set(), []
+        for token in tokens:
+            key = short(token)
+            if key in seen or key in sessions:
+                progress["dup"] += 1
+                continue
+            seen.add(key)
+            fresh.append(token)
+        progress["to_check"] = len(fresh)
+
+        sem   = asyncio.Semaphore(BOOT_CONCURRENCY)
+        valid = []
+
+        async def _check(token):
+            async with sem:
+                result = await detect_tenant(token)
+            progress["checked"] += 1
+            if result:
+                valid.append((token, result[0]))
+            else:
+                progress["invalid"] += 1
+
+        await asyncio.gather(*[_check(t) for t in fresh])
+
+        now = clock.now()
+        if valid and not await db_save_tokens_many([(short(t), t, tid, now, now) for t, tid in valid]):
+            progress["error"] = "lỗi ghi DB"
+            return
+        progress["saved"] = len(valid)
+
+        for token, tenant_id in valid:
+            s = new_session(token, tenant_id, added_at=now, validated_at=now)
+            if not await add_session(s):
+                continue  # đã được thêm bằng lệnh khác trong lúc nhập
+            add_log(s, f"nhập bởi {by}", "success")
+            await start_afk_session(s.short)
+            progress["started"] += 1
+            await asyncio.sleep(1 / BOOT_ADMIT_RATE)
+        console_print(f"[IMPORT] {by}: {progress['started']} token mới, {progress['invalid']} không hợp lệ, "
+                      f"{progress['dup']} trùng")
+    except Exception as e:
+        progress["error"] = str(e)[:200]
+        console_print(f"[IMPORT] lỗi: {e}")
+    finally:
+        progress["done"] = True
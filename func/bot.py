@@ -1,18 +1,21 @@
 import os
 import asyncio
-import aiohttp
+import tempfile
 import discord
 from discord.ext import commands
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 from func.state import (
-    sessions, lock, session_snapshot,
-    new_session, add_log, detect_tenant, short as mk_short,
-    db_save_token, db_delete_token,
-    set_log_channel,
+    set_log_channel, start_loop_monitor, db_query_series, db_export_logs, SERIES_MINUTE, SERIES_HOUR, SERIES_DAY,
+    console_print,
+)
+from func.afk import load_all_tokens, start_stats_flusher
+from func.shard import (
+    SHARDS, ShardError,
+    farm_add, farm_remove, farm_restart, farm_perf, farm_lookup, farm_tails, farm_summary, farm_page, farm_stats,
+    farm_import, farm_import_status, farm_export,
 )
-from func.afk import start_afk_session, stop_afk_session, load_all_tokens
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv("TOKEN")
@@ -21,8 +24,30 @@ if not DISCORD_TOKEN:
 
 KENH_LOG = int(os.getenv("LOG_CHANNEL_ID", "0"))
 
+# /lich-su: khoảng thời gian -> (giây, độ phân giải bucket)
+HISTORY_RANGES = {
+    "1h":  (3600,       SERIES_MINUTE),
+    "24h": (86400,      SERIES_HOUR),
+    "7d":  (7 * 86400,  SERIES_HOUR),
+    "30d": (30 * 86400, SERIES_DAY),
+}
+HISTORY_ROWS = 12       # số bucket gần nhất in dạng bảng
+SPARK        = "▁▂▃▄▅▆▇█"
+
+PAGE_SIZE    = 10      # session mỗi trang /danh-sach
+LIST_TIMEOUT = 600     # giây trước khi nút của /danh-sach hết hiệu lực
+
+STATUS_BOARD_INTERVAL = int(os.getenv("STATUS_BOARD_INTERVAL", "0"))  # giây giữa các lần cập nhật tin ghim; 0 = tắt
+STATUS_BOARD_TITLE    = "Trạng thái farm"
+
+LOG_EXPORT_MAX_BYTES = 8 * 1024 * 1024  # file /xuat-log tối đa (giới hạn đính kèm của Discord)
+
+IMPORT_MAX_BYTES      = 2 * 1024 * 1024  # file token tối đa cho /nhap-token
+IMPORT_PROGRESS_EVERY = 3                # giây giữa các lần sửa tin nhắn tiến độ
+
 intents = discord.Intents.default()
 bot = commands.Bot(command_prefix="!", intents=intents)
+_board_task: asyncio.Task = None
 
 STATUS_TEXT = {
     "farming":  "Đang farm",
@@ -30,6 +55,7 @@ STATUS_TEXT = {
     "starting": "Đang khởi động",
     "stopped":  "Đã dừng",
     "idle":     "Chờ",
+    "paused":   "Tạm ngưng (API lỗi)",
 }
 
 
@@ -37,43 +63,319 @@ def _ts():
     return datetime.now(timezone.utc)
 
 
+def _ms(v: float) -> str:
+    return f"{v * 1000:.0f}ms"
+
+
+def _hist_line(h) -> str:
+    if h is None or not h.count:
+        return "`chưa có số liệu`"
+    sm = h.summary()
+    return f"p50 `{_ms(sm['p50'])}` | p99 `{_ms(sm['p99'])}` | max `{_ms(sm['max'])}` | n=`{sm['count']}`"
+
+
 @bot.event
 async def on_ready():
-    print(f"[BOT] {bot.user}")
+    console_print(f"[BOT] {bot.user}")
     if KENH_LOG:
         ch = bot.get_channel(KENH_LOG) or await bot.fetch_channel(KENH_LOG)
         set_log_channel(ch)
-        print(f"[BOT] Kênh log: #{ch.name}")
-    await load_all_tokens()
+        console_print(f"[BOT] Kênh log: #{ch.name}")
+    start_loop_monitor()
+    global _board_task
+    if KENH_LOG and STATUS_BOARD_INTERVAL and _board_task is None:  # on_ready chạy lại mỗi lần reconnect
+        _board_task = asyncio.create_task(_status_board(ch))
+    if not SHARDS:  # chế độ nhiều process: các shard tự nạp token của mình
+        start_stats_flusher()
+        await load_all_tokens()
     synced = await bot.tree.sync()
-    print(f"[BOT] {len(synced)} lệnh đã sync")
+    console_print(f"[BOT] {len(synced)} lệnh đã sync")
+
+
+def _board_embed(summary: dict, brk: dict) -> discord.Embed:
+    em = discord.Embed(title=STATUS_BOARD_TITLE, color=0x00E5F0 if brk["state"] == "closed" else 0xf85149)
+    counts = summary["counts"]
+    em.description = "\n".join(
+        f"{text}: `{counts.get(st, 0)}`" for st, text in STATUS_TEXT.items() if counts.get(st, 0)
+    ) or "Chưa có session nào."
+    em.add_field(name="Token",     value=f"`{summary['total']}`",                       inline=True)
+    em.add_field(name="HB ok/lỗi", value=f"`{summary['hb_ok']}/{summary['hb_fail']}`", inline=True)
+    em.add_field(name="API",       value=f"`{brk['state']}`",                           inline=True)
+    return em
+
+
+async def _find_board(channel) -> discord.Message:
+    pins = channel.pins()
+    if hasattr(pins, "__aiter__"):  # discord.py >= 2.6: iterator phân trang
+        pins = [m async for m in pins]
+    else:                           # bản cũ hơn: coroutine trả về list
+        pins = await pins
+    for msg in pins:
+        if msg.author == bot.user and msg.embeds and msg.embeds[0].title == STATUS_BOARD_TITLE:
+            return msg
+    return None
+
+
+async def _status_board(channel):
+    """Tin nhắn ghim trong kênh log, sửa tại chỗ mỗi STATUS_BOARD_INTERVAL giây — chỉ khi số liệu đổi."""
+    msg, last = None, None
+    while True:
+        try:
+            st = await farm_stats()
+            em = _board_embed(await farm_summary(), st["breaker"])
+            key = em.to_dict()  # so sánh trước khi gắn timestamp
+            em.timestamp = _ts()
+            if msg is None:
+                msg = await _find_board(channel)
+                if msg is None:
+                    msg = await channel.send(embed=em)
+                    await msg.pin()
+                    last = key
+            if key != last:
+                await msg.edit(embed=em)
+                last = key
+        except discord.NotFound:
+            msg, last = None, None  # tin ghim bị xóa — lần sau gửi lại
+        except (discord.HTTPException, ShardError) as e:
+            console_print(f"[BOARD] {e}")
+        except Exception as e:  # lỗi bất ngờ không được làm chết bảng — lần sau thử lại
+            console_print(f"[BOARD] lỗi: {type(e).__name__}: {e}")
+        await asyncio.sleep(STATUS_BOARD_INTERVAL)
+
+
+async def _resolve_tail(interaction: discord.Interaction, tail: str):
+    keys = await farm_lookup(tail)
+    if not keys:
+        await interaction.followup.send("Không tìm thấy token.", ephemeral=True)
+        return None
+    if len(keys) > 1:
+        await interaction.followup.send(
+            f"Tail `{tail.strip()}` trùng với {len(keys)} token — nhập thêm ký tự cuối để phân biệt.",
+            ephemeral=True,
+        )
+        return None
+    return keys[0]
+
+
+async def _tail_autocomplete(interaction: discord.Interaction, current: str):
+    choices = []
+    for t, n, status in await farm_tails(current):
+        name = f"...{t}" if n <= 1 else f"...{t} ({n} token trùng)"
+        if status:
+            name += f" — {STATUS_TEXT.get(status, '')}"
+        choices.append(discord.app_commands.Choice(name=name, value=t))
+    return choices
+
+
+def _farm_header(summary: dict, st: dict) -> str:
+    """Dòng tổng quan dùng chung cho /danh-sach và bảng trạng thái ghim."""
+    counts  = summary["counts"]
+    metrics = st["metrics"]
+    sch     = st["scheduler"]
+    lq      = st["log_queue"]
+    text = (
+        f"{summary['total']} token | {counts.get('farming', 0)} đang farm | "
+        f"HB `{summary['hb_ok']}/{summary['hb_fail']}`\n"
+        f"Scheduler: `{sch['pending']}` chờ | `{sch['queued'] + sch['running']}` đang chạy | "
+        f"trễ TB `{sch['late_avg']:.2f}s` | trễ max `{sch['late_max']:.1f}s`\n"
+        f"Log: `{lq['pending'] + lq['urgent']}` chờ | `{lq['dropped']}` dòng bị bỏ | "
+        f"`{lq['lagged']}` tin trễ"
+    )
+    hb_lat = metrics.get("heartbeat_latency")
+    if hb_lat is not None and hb_lat.count:
+        text += (
+            f"\nHB p50/p99 `{_ms(hb_lat.quantile(0.5))}`/`{_ms(hb_lat.quantile(0.99))}` | "
+            f"lệch nhịp p99 `{_ms(metrics['hb_drift'].quantile(0.99))}` | "
+            f"lag loop p99 `{_ms(metrics['loop_lag'].quantile(0.99))}`"
+        )
+    brk = st["breaker"]
+    if brk["state"] != "closed":
+        text += f"\nAPI: ngắt mạch (`{brk['state']}`) | `{brk['rejected']}` request đã chặn"
+    return text
+
+
+class SessionList(discord.ui.View):
+    """Danh sách session có phân trang và lọc theo trạng thái — mỗi lần bấm chỉ hỏi đúng một trang."""
+
+    def __init__(self):
+        super().__init__(timeout=LIST_TIMEOUT)
+        self.status = None
+        self.page   = 0
+
+    async def render(self) -> discord.Embed:
+        farm  = await farm_page(self.status, self.page, PAGE_SIZE)
+        pages = max((farm["total"] + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+        if self.page >= pages:  # session bị xóa khiến trang hiện tại không còn
+            self.page = pages - 1
+            farm = await farm_page(self.status, self.page, PAGE_SIZE)
+
+        em = discord.Embed(title="Farm Sessions", color=0x00E5F0, timestamp=_ts())
+        em.description = _farm_header(farm["summary"], await farm_stats())
+        for s in farm["items"]:
+            lt  = s.get("lifetime", {})
+            val = (
+                f"{STATUS_TEXT.get(s['afk_status'], s['afk_status'])}\n"
+                f"Uptime: `{s['uptime']}` | HB: `{s['hb_ok']}/{s['hb_fail']}`\n"
+                f"HB lifetime: `{lt.get('total_hb_ok', 0)}/{lt.get('total_hb_fail', 0)}`"
+            )
+            if s["afk_error"]:
+                val += f"\n`{s['afk_error'][:80]}`"
+            em.add_field(name=f"...{s['token_tail']}", value=val, inline=False)
+        if not farm["items"]:
+            em.add_field(name="Không có session", value="Không có session nào ở trạng thái này.", inline=False)
+        label = STATUS_TEXT.get(self.status, "Tất cả") if self.status else "Tất cả"
+        em.set_footer(text=f"{label} | trang {self.page + 1}/{pages} | {farm['total']} session")
+
+        counts = farm["summary"]["counts"]
+        self.pick.options = [
+            discord.SelectOption(label=f"Tất cả ({farm['summary']['total']})", value="*",
+                                 default=self.status is None),
+        ] + [
+            discord.SelectOption(label=f"{text} ({counts.get(st, 0)})", value=st, default=self.status == st)
+            for st, text in STATUS_TEXT.items()
+        ]
+        self.prev.disabled = self.page == 0
+        self.next.disabled = self.page >= pages - 1
+        return em
+
+    async def _refresh(self, interaction: discord.Interaction):
+        try:
+            em = await self.render()
+        except ShardError as e:
+            await interaction.response.send_message(f"Shard không phản hồi: {e}", ephemeral=True)
+            return
+        await interaction.response.edit_message(embed=em, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def prev(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page = max(self.page - 1, 0)
+        await self._refresh(interaction)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self._refresh(interaction)
+
+    @discord.ui.button(label="Làm mới", style=discord.ButtonStyle.primary)
+    async def reload(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._refresh(interaction)
+
+    @discord.ui.select(placeholder="Lọc theo trạng thái", row=1)
+    async def pick(self, interaction: discord.Interaction, select: discord.ui.Select):
+        value       = select.values[0]
+        self.status = None if value == "*" else value
+        self.page   = 0
+        await self._refresh(interaction)
 
 
 @bot.tree.command(name="danh-sach", description="Xem tất cả session đang chạy")
 async def cmd_ds(interaction: discord.Interaction):
-    async with lock:
-        snaps = [session_snapshot(s) for s in sessions.values()]
+    # bộ đếm theo trạng thái có sẵn — chỉ snapshot đúng một trang, không quét cả farm
+    await interaction.response.defer(ephemeral=True)
+    view = SessionList()
+    try:
+        em = await view.render()
+    except ShardError as e:
+        await interaction.followup.send(f"Shard không phản hồi: {e}", ephemeral=True)
+        return
+    await interaction.followup.send(embed=em, view=view, ephemeral=True)
 
-    if not snaps:
-        await interaction.response.send_message("Chưa có session nào.", ephemeral=True)
+
+@bot.tree.command(name="hieu-nang", description="Xem số liệu hiệu năng: độ trễ, retry, lệch nhịp, lag")
+@discord.app_commands.describe(tail="8 ký tự cuối của token (bỏ trống để xem toàn farm)")
+@discord.app_commands.autocomplete(tail=_tail_autocomplete)
+async def cmd_hieu_nang(interaction: discord.Interaction, tail: str = None):
+    await interaction.response.defer(ephemeral=True)
+    if tail:
+        keys = await farm_lookup(tail)
+        try:
+            p = await farm_perf(keys[0]) if len(keys) == 1 else None
+        except ShardError as e:
+            await interaction.followup.send(f"Shard giữ token này không phản hồi: {e}", ephemeral=True)
+            return
+        if p is None:
+            await interaction.followup.send(
+                "Tail bị trùng — nhập thêm ký tự." if len(keys) > 1 else "Không tìm thấy token.", ephemeral=True)
+            return
+        em = discord.Embed(title=f"Hiệu năng ...{p['tail']}", color=0x00E5F0, timestamp=_ts())
+        em.add_field(name="Độ trễ heartbeat", value=_hist_line(p["hb_latency"]), inline=False)
+        em.add_field(name="Lệch nhịp heartbeat", value=_hist_line(p["hb_drift"]), inline=False)
+        em.add_field(name="Retry", value=f"`{p['retries']}` lần", inline=False)
+        await interaction.followup.send(embed=em, ephemeral=True)
         return
 
-    farming = sum(1 for s in snaps if s["afk_status"] == "farming")
-    em = discord.Embed(title="Farm Sessions", color=0x00E5F0, timestamp=_ts())
-    em.description = f"{len(snaps)} token | {farming} đang farm"
+    st      = await farm_stats()
+    metrics = st["metrics"]
+    em = discord.Embed(title="Hiệu năng farm", color=0x00E5F0, timestamp=_ts())
+    for kind in ("heartbeat", "start", "tenants"):
+        lat = metrics.get(f"{kind}_latency")
+        rt  = metrics.get(f"{kind}_retries")
+        val = _hist_line(lat)
+        if rt is not None and rt.count:
+            val += f"\nRetry: TB `{rt.sum / rt.count:.2f}` | max `{rt.max:.0f}` | tổng `{rt.sum:.0f}`"
+        em.add_field(name=f"Độ trễ {kind}", value=val, inline=False)
+    em.add_field(name="Lệch nhịp heartbeat", value=_hist_line(metrics["hb_drift"]), inline=False)
+    em.add_field(name="Lag event loop", value=_hist_line(metrics["loop_lag"]), inline=False)
+    if "loop_lag_bot" in metrics:
+        em.add_field(name="Lag event loop (bot)", value=_hist_line(metrics["loop_lag_bot"]), inline=False)
+    sch = st["scheduler"]
+    em.add_field(
+        name="Scheduler",
+        value=f"`{sch['pending']}` chờ | `{sch['queued']}` trong hàng | `{sch['running']}` đang chạy | "
+              f"trễ TB `{_ms(sch['late_avg'])}` | max `{_ms(sch['late_max'])}`",
+        inline=False,
+    )
+    await interaction.followup.send(embed=em, ephemeral=True)
 
-    for s in snaps[:20]:
-        lt  = s.get("lifetime", {})
-        val = (
-            f"{STATUS_TEXT.get(s['afk_status'], s['afk_status'])}\n"
-            f"Uptime: `{s['uptime']}` | HB: `{s['hb_ok']}/{s['hb_fail']}`\n"
-            f"HB lifetime: `{lt.get('total_hb_ok', 0)}/{lt.get('total_hb_fail', 0)}`"
-        )
-        if s["afk_error"]:
-            val += f"\n`{s['afk_error'][:80]}`"
-        em.add_field(name=f"...{s['token_tail']}", value=val, inline=False)
 
-    await interaction.response.send_message(embed=em, ephemeral=True)
+def _spark(values: list) -> str:
+    top = max(values, default=0)
+    if not top:
+        return SPARK[0] * len(values)
+    return "".join(SPARK[min(int(v / top * (len(SPARK) - 1) + 0.5), len(SPARK) - 1)] for v in values)
+
+
+@bot.tree.command(name="lich-su", description="Lịch sử heartbeat theo thời gian của farm hoặc một token")
+@discord.app_commands.describe(khoang="Khoảng thời gian", tail="8 ký tự cuối của token (bỏ trống để xem toàn farm)")
+@discord.app_commands.choices(khoang=[discord.app_commands.Choice(name=k, value=k) for k in HISTORY_RANGES])
+@discord.app_commands.autocomplete(tail=_tail_autocomplete)
+async def cmd_lich_su(interaction: discord.Interaction, khoang: str = "24h", tail: str = None):
+    await interaction.response.defer(ephemeral=True)
+
+    key = None
+    if tail:
+        key = await _resolve_tail(interaction, tail)
+        if not key:
+            return
+    span, res = HISTORY_RANGES[khoang]
+    now   = int(_ts().timestamp())
+    since = now - span
+    rows  = {r[0]: r for r in await db_query_series(since, res, key)}
+
+    first   = since - since % res
+    buckets = [rows.get(b, (b, 0, 0, 0)) for b in range(first, now + 1, res)]
+    total_ok   = sum(r[1] for r in buckets)
+    total_fail = sum(r[2] for r in buckets)
+    total      = total_ok + total_fail
+
+    title = f"Lịch sử {khoang}" + (f" — ...{key[-8:]}" if key else " — toàn farm")
+    em = discord.Embed(title=title, color=0x00E5F0, timestamp=_ts())
+    em.description = (
+        f"HB ok `{total_ok}` | lỗi `{total_fail}` | "
+        f"thành công `{total_ok / total * 100 if total else 0:.1f}%` | "
+        f"uptime `{sum(r[3] for r in buckets) / 3600:.1f}h`"
+    )
+    em.add_field(name="HB ok", value=f"`{_spark([r[1] for r in buckets])}`", inline=False)
+    em.add_field(name="% lỗi", value=f"`{_spark([r[2] / (r[1] + r[2]) if r[1] + r[2] else 0 for r in buckets])}`",
+                 inline=False)
+    fmt   = "%H:%M" if res < SERIES_DAY else "%d/%m"
+    lines = [
+        f"{datetime.fromtimestamp(b).strftime(fmt):>5}  ok {ok:>7}  lỗi {fail:>5}  "
+        f"{ok / (ok + fail) * 100 if ok + fail else 0:5.1f}%"
+        for b, ok, fail, _ in buckets[-HISTORY_ROWS:]
+    ]
+    em.add_field(name=f"{len(lines)} bucket gần nhất", value="```" + "\n".join(lines) + "```", inline=False)
+    await interaction.followup.send(embed=em, ephemeral=True)
 
 
 @bot.tree.command(name="them-token", description="Thêm token Altare vào hệ thống")
@@ -84,29 +386,18 @@ async def cmd_them(interaction: discord.Interaction, token: str):
     token = token.strip()
     if not token.startswith("Bearer "):
         token = f"Bearer {token}"
-    key = mk_short(token)
-
-    async with lock:
-        if key in sessions:
-            await interaction.followup.send("Token đã tồn tại.", ephemeral=True)
-            return
-
-    async with aiohttp.ClientSession() as http:
-        result = await detect_tenant(http, token)
-
-    if not result:
+    try:
+        res = await farm_add(token, str(interaction.user))
+    except ShardError as e:
+        await interaction.followup.send(f"Shard giữ token này không phản hồi: {e}", ephemeral=True)
+        return
+    if res.get("error") == "exists":
+        await interaction.followup.send("Token đã tồn tại.", ephemeral=True)
+        return
+    if res.get("error"):
         await interaction.followup.send("Token không hợp lệ hoặc hết hạn.", ephemeral=True)
         return
-
-    tenant_id = result[0]
-
-    async with lock:
-        s = new_session(token, tenant_id)
-        sessions[key] = s
-        add_log(s, f"thêm bởi {interaction.user}", "success")
-
-    db_save_token(key, token, tenant_id, s["added_at"])
-    await start_afk_session(key)
+    tenant_id = res["tenant_id"]
 
     em = discord.Embed(title="Token đã thêm", color=0x4caf50, timestamp=_ts())
     em.add_field(name="Tenant ID",    value=f"`{tenant_id}`",     inline=True)
@@ -115,34 +406,131 @@ async def cmd_them(interaction: discord.Interaction, token: str):
     await interaction.followup.send(embed=em, ephemeral=True)
 
 
-@bot.tree.command(name="xoa-token", description="Xóa vĩnh viễn token khỏi hệ thống")
-@discord.app_commands.describe(tail="8 ký tự cuối của token")
-async def cmd_xoa(interaction: discord.Interaction, tail: str):
+def _parse_tokens(text: str) -> list[str]:
+    """Mỗi dòng một token, bỏ dòng trống và dòng bắt đầu bằng #; tự thêm "Bearer "."""
+    out = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        out.append(line if line.startswith("Bearer ") else f"Bearer {line}")
+    return out
+
+
+def _import_embed(p: dict) -> discord.Embed:
+    done  = p["done"]
+    color = 0xf85149 if p["error"] else 0x4caf50 if done else 0xd29922
+    em = discord.Embed(title="Nhập token — xong" if done else "Đang nhập token...", color=color, timestamp=_ts())
+    em.add_field(name="Dòng",         value=f"`{p['lines']}`",                   inline=True)
+    em.add_field(name="Trùng",        value=f"`{p['dup']}`",                     inline=True)
+    em.add_field(name="Đã kiểm tra",  value=f"`{p['checked']}/{p['to_check']}`", inline=True)
+    em.add_field(name="Không hợp lệ", value=f"`{p['invalid']}`",                 inline=True)
+    em.add_field(name="Đã lưu",       value=f"`{p['saved']}`",                   inline=True)
+    em.add_field(name="Đã khởi động", value=f"`{p['started']}/{p['saved']}`",    inline=True)
+    if p["error"]:
+        em.add_field(name="Lỗi", value=f"`{p['error'][:200]}`", inline=False)
+    return em
+
+
+@bot.tree.command(name="nhap-token", description="Nhập nhiều token từ file .txt (mỗi dòng một token)")
+@discord.app_commands.describe(file="File văn bản, mỗi dòng một Bearer token")
+async def cmd_nhap(interaction: discord.Interaction, file: discord.Attachment):
     await interaction.response.defer(ephemeral=True)
 
-    target_key = None
-    async with lock:
-        for k, s in sessions.items():
-            if s["token"][-8:] == tail.strip():
-                target_key = k
-                break
+    if file.size > IMPORT_MAX_BYTES:
+        await interaction.followup.send(f"File quá lớn (tối đa {IMPORT_MAX_BYTES // 1024} KB).", ephemeral=True)
+        return
+    tokens = _parse_tokens((await file.read()).decode("utf-8", errors="ignore"))
+    if not tokens:
+        await interaction.followup.send("File không có token nào.", ephemeral=True)
+        return
 
-    if not target_key:
-        await interaction.followup.send("Không tìm thấy token.", ephemeral=True)
+    try:
+        jobs = await farm_import(tokens, str(interaction.user))
+    except ShardError as e:
+        await interaction.followup.send(f"Shard không phản hồi: {e}", ephemeral=True)
         return
+    p   = await farm_import_status(jobs)
+    msg = await interaction.followup.send(embed=_import_embed(p), ephemeral=True, wait=True)
+    while not p["done"]:
+        await asyncio.sleep(IMPORT_PROGRESS_EVERY)
+        p = await farm_import_status(jobs)
+        try:
+            await msg.edit(embed=_import_embed(p))
+        except discord.HTTPException:
+            break  # token interaction hết hạn (15 phút) — việc nhập vẫn chạy tiếp
+
+
+@bot.tree.command(name="xuat-token", description="Xuất toàn bộ token ra file .txt")
+@discord.app_commands.default_permissions(administrator=True)  # file chứa Bearer token đầy đủ
+@discord.app_commands.guild_only()                               # DM không áp quyền server
+async def cmd_xuat(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+
+    fd, path = tempfile.mkstemp(prefix="altare-tokens-", suffix=".txt")
+    os.close(fd)
+    try:
+        n = await farm_export(path)
+        if not n:
+            await interaction.followup.send("Chưa có token nào.", ephemeral=True)
+            return
+        await interaction.followup.send(
+            f"{n} token.", file=discord.File(path, filename="tokens.txt"), ephemeral=True)
+    finally:
+        os.remove(path)
+
+
+@bot.tree.command(name="xuat-log", description="Xuất log đã lưu ra file .txt, lọc theo token, mức log và thời gian")
+@discord.app_commands.default_permissions(administrator=True)  # log của mọi token, không riêng người gọi
+@discord.app_commands.guild_only()
+@discord.app_commands.describe(
+    khoang="Khoảng thời gian tính tới hiện tại",
+    muc="Mức log thấp nhất",
+    tail="8 ký tự cuối của token, \"farm\" cho log chung (bỏ trống để xem tất cả)",
+)
+@discord.app_commands.choices(
+    khoang=[discord.app_commands.Choice(name=k, value=k) for k in HISTORY_RANGES],
+    muc=[discord.app_commands.Choice(name=lv, value=lv) for lv in ("info", "success", "warn", "error")],
+)
+@discord.app_commands.autocomplete(tail=_tail_autocomplete)
+async def cmd_xuat_log(interaction: discord.Interaction, khoang: str = "24h", muc: str = "info", tail: str = None):
+    # đọc thẳng DB — token đã xóa vẫn xem được log cũ, không cần tra session
+    await interaction.response.defer(ephemeral=True)
 
-    async with lock:
-        if target_key not in sessions:
-            await interaction.followup.send("Session đã biến mất.", ephemeral=True)
+    since    = _ts().timestamp() - HISTORY_RANGES[khoang][0]
+    fd, path = tempfile.mkstemp(prefix="altare-logs-", suffix=".txt")
+    os.close(fd)
+    try:
+        n, cut = await db_export_logs(path, since, tail=tail, min_level=muc, max_bytes=LOG_EXPORT_MAX_BYTES)
+        if not n:
+            await interaction.followup.send("Không có dòng log nào khớp.", ephemeral=True)
             return
-        s = sessions.pop(target_key)
+        note = f"{n} dòng log ({khoang}, từ mức {muc}" + (f", token ...{tail}" if tail else "") + ")."
+        if cut:
+            note += f" Đã cắt ở {LOG_EXPORT_MAX_BYTES // (1024 * 1024)} MB — thu hẹp khoảng thời gian để xem phần sau."
+        await interaction.followup.send(note, file=discord.File(path, filename="logs.txt"), ephemeral=True)
+    finally:
+        os.remove(path)
 
-    for attr in ("afk_task", "afk_stats_task"):
-        tk = s.get(attr)
-        if tk and not tk.done():
-            tk.cancel()
 
-    db_delete_token(target_key)
+@bot.tree.command(name="xoa-token", description="Xóa vĩnh viễn token khỏi hệ thống")
+@discord.app_commands.describe(tail="8 ký tự cuối của token")
+@discord.app_commands.autocomplete(tail=_tail_autocomplete)
+async def cmd_xoa(interaction: discord.Interaction, tail: str):
+    await interaction.response.defer(ephemeral=True)
+
+    target_key = await _resolve_tail(interaction, tail)
+    if not target_key:
+        return
+
+    try:
+        removed = await farm_remove(target_key)
+    except ShardError as e:
+        await interaction.followup.send(f"Shard giữ token này không phản hồi: {e}", ephemeral=True)
+        return
+    if not removed:
+        await interaction.followup.send("Session đã biến mất.", ephemeral=True)
+        return
 
     em = discord.Embed(title="Token đã xóa", color=0xf85149, timestamp=_ts())
     em.add_field(name="Token", value=f"`...{tail}`", inline=True)
@@ -151,23 +539,22 @@ async def cmd_xoa(interaction: discord.Interaction, tail: str):
 
 @bot.tree.command(name="restart-token", description="Khởi động lại một token cụ thể")
 @discord.app_commands.describe(tail="8 ký tự cuối của token")
+@discord.app_commands.autocomplete(tail=_tail_autocomplete)
 async def cmd_restart(interaction: discord.Interaction, tail: str):
     await interaction.response.defer(ephemeral=True)
 
-    target_key = None
-    async with lock:
-        for k, s in sessions.items():
-            if s["token"][-8:] == tail.strip():
-                target_key = k
-                break
-
+    target_key = await _resolve_tail(interaction, tail)
     if not target_key:
-        await interaction.followup.send("Không tìm thấy token.", ephemeral=True)
         return
 
-    await stop_afk_session(target_key)
-    await asyncio.sleep(1)
-    await start_afk_session(target_key)
+    try:
+        restarted = await farm_restart(target_key)
+    except ShardError as e:
+        await interaction.followup.send(f"Shard giữ token này không phản hồi: {e}", ephemeral=True)
+        return
+    if not restarted:
+        await interaction.followup.send("Session đã biến mất.", ephemeral=True)
+        return
 
     em = discord.Embed(title="Đã restart", color=0xd29922, timestamp=_ts())
     em.add_field(name="Token", value=f"`...{tail}`", inline=True)
@@ -0,0 +1,89 @@
+"""Nguồn thời gian dùng chung cho func/afk.py và func/state.py.
+
+Mặc định là đồng hồ thật. Khi mô phỏng, chạy trong VirtualEventLoop rồi gọi
+use_loop_clock(loop): loop.time() nhảy thẳng tới timer kế tiếp thay vì chờ,
+nên asyncio.sleep, scheduler và mọi phép tính uptime chạy theo thời gian ảo.
+"""
+import time
+import asyncio
+import selectors
+from datetime import datetime
+
+_wall = time.time
+_mono = time.monotonic
+
+
+def now() -> float:
+    """Thời gian kiểu time.time()."""
+    return _wall()
+
+
+def monotonic() -> float:
+    """Thời gian đơn điệu kiểu time.monotonic()."""
+    return _mono()
+
+
+def now_dt() -> datetime:
+    return datetime.fromtimestamp(_wall())
+
+
+def use_loop_clock(loop: "VirtualEventLoop"):
+    global _wall, _mono
+    _wall = loop.wall_time
+    _mono = loop.time
+
+
+def use_real_clock():
+    global _wall, _mono
+    _wall = time.time
+    _mono = time.monotonic
+
+
+class _VirtualSelector:
+    """Bọc selector thật: không có I/O sẵn sàng thì tua thời gian ảo thay vì chờ."""
+
+    def __init__(self, loop: "VirtualEventLoop", inner: selectors.BaseSelector):
+        self._loop  = loop
+        self._inner = inner
+
+    def select(self, timeout=None):
+        events = self._inner.select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None or self._loop._external > 0:
+            # không còn timer nào, hoặc còn việc đang chạy ở luồng khác (DB, DNS) — chờ thật
+            return self._inner.select(timeout)
+        self._loop._vnow += timeout
+        return []
+
+    def __getattr__(self, name):
+        return getattr(self._inner, name)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """Event loop dùng thời gian ảo.
+
+    I/O qua socket loopback (mock API chạy cùng loop) vẫn hoạt động vì dữ liệu đã sẵn sàng
+    ngay khi select(0); việc đẩy sang executor được đếm để loop chờ thật tới khi xong.
+    """
+
+    def __init__(self, start: float = None):
+        self._vnow      = 0.0
+        self._wall0     = time.time() if start is None else start
+        self._external  = 0
+        super().__init__(_VirtualSelector(self, selectors.DefaultSelector()))
+
+    def time(self) -> float:
+        return self._vnow
+
+    def wall_time(self) -> float:
+        return self._wall0 + self._vnow
+
+    def run_in_executor(self, executor, func, *args):
+        fut = super().run_in_executor(executor, func, *args)
+        self._external += 1
+        fut.add_done_callback(self._external_done)
+        return fut
+
+    def _external_done(self, fut):
+        self._external -= 1
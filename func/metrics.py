@@ -0,0 +1,166 @@
+import os
+import psutil
+from aiohttp import web
+
+from func import clock
+from func.state import (
+    sessions, status_counts, metrics, counters, log_queue_stats, log_store_stats, breaker_stats, LOG_QUEUE_MAX,
+    console_print,
+)
+from func.afk import scheduler_stats
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = tắt endpoint
+
+_runner: web.AppRunner = None
+_proc = psutil.Process()
+_started = clock.now()
+
+# tên histogram trong state.metrics -> (tên Prometheus, nhãn)
+_HIST_NAMES = {
+    "hb_drift": ("altare_heartbeat_drift_seconds", ""),
+    "loop_lag": ("altare_event_loop_lag_seconds", ""),
+    "db_flush": ("altare_db_flush_seconds", ""),
+}
+
+
+def _hist_name(key: str) -> tuple[str, str]:
+    if key in _HIST_NAMES:
+        return _HIST_NAMES[key]
+    kind, _, what = key.rpartition("_")
+    if what == "latency":
+        return "altare_request_latency_seconds", f'kind="{kind}"'
+    return "altare_request_retries", f'kind="{kind}"'
+
+
+def _status_counts() -> dict:
+    return {st: n for st, n in status_counts.items() if n}
+
+
+def render_prometheus() -> str:
+    lines = []
+
+    def metric(name: str, kind: str, help_: str, samples: list):
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    metric("altare_sessions", "gauge", "Số session theo afk_status",
+           [(f'status="{st}"', n) for st, n in sorted(_status_counts().items())])
+    metric("altare_heartbeats_total", "counter", "Heartbeat từ lúc process chạy",
+           [('result="ok"', counters["hb_ok"]), ('result="fail"', counters["hb_fail"])])
+    metric("altare_db_flush_rows_total", "counter", "Số dòng lifetime_stats đã ghi",
+           [("", counters["db_flush_rows"])])
+    metric("altare_db_flush_errors_total", "counter", "Số lần flush stats lỗi",
+           [("", counters["db_flush_errors"])])
+
+    metric("altare_stop_calls_total", "counter", "Lệnh stop trước khi start: đã gửi / bỏ qua vì đã biết trạng thái",
+           [('result="sent"', counters["stop_sent"]), ('result="skipped"', counters["stop_skipped"])])
+    metric("altare_start_conflicts_total", "counter", "Start bị từ chối vì phiên cũ còn chạy",
+           [("", counters["start_conflict"])])
+
+    lq = log_queue_stats()
+    metric("altare_log_queue_depth", "gauge", "Số dòng log đang chờ gửi Discord",
+           [('lane="normal"', lq["pending"]), ('lane="urgent"', lq["urgent"])])
+    metric("altare_log_queue_capacity", "gauge", "Sức chứa mỗi lane log", [("", LOG_QUEUE_MAX)])
+    metric("altare_log_dropped_total", "counter", "Dòng log bị bỏ", [("", lq["dropped"])])
+    metric("altare_log_lagged_messages_total", "counter", "Tin nhắn log gửi trễ", [("", lq["lagged"])])
+
+    ls = log_store_stats()
+    metric("altare_log_store_pending", "gauge", "Dòng log chờ ghi DB", [("", ls["pending"])])
+    metric("altare_log_store_rows_total", "counter", "Dòng log theo kết quả ghi DB",
+           [('result="stored"', ls["stored"]), ('result="dropped"', ls["dropped"]),
+            ('result="error"', ls["errors"])])
+    metric("altare_log_console_dropped_total", "counter", "Dòng log console bị bỏ vì stdout chậm",
+           [("", ls["console_dropped"])])
+
+    sch = scheduler_stats()
+    metric("altare_scheduler_pending", "gauge", "Job đang chờ đến hạn", [("", sch["pending"])])
+    metric("altare_scheduler_running", "gauge", "Job đang chạy hoặc trong hàng",
+           [("", sch["running"] + sch["queued"])])
+    metric("altare_scheduler_late_max_seconds", "gauge", "Độ trễ lớn nhất khi kích hoạt job",
+           [("", sch["late_max"])])
+
+    brk = breaker_stats()
+    metric("altare_breaker_state", "gauge", "Trạng thái ngắt mạch API (1 = đang ở trạng thái đó)",
+           [(f'state="{st}"', int(brk["state"] == st)) for st in ("closed", "open", "half_open")])
+    metric("altare_breaker_trips_total", "counter", "Số lần ngắt mạch", [("", brk["trips"])])
+    metric("altare_breaker_rejected_total", "counter", "Request bị chặn khi ngắt mạch", [("", brk["rejected"])])
+    metric("altare_api_rate_limit", "gauge", "Giới hạn request/giây hiện tại (0 = không giới hạn)", [("", brk["rate"])])
+    metric("altare_api_throttled_total", "counter", "Request không được gửi vì vượt API_RATE trước hạn chót",
+           [("", counters["throttled"])])
+    metric("altare_api_rate_wait_seconds_total", "counter", "Tổng thời gian chờ token bucket",
+           [("", brk["waited"])])
+
+    grouped: dict[str, list] = {}
+    for key, h in list(metrics.items()):
+        name, label = _hist_name(key)
+        grouped.setdefault(name, []).append((label, h))
+    for name, items in grouped.items():
+        lines.append(f"# TYPE {name} histogram")
+        for label, h in items:
+            sep, cum = ("," if label else ""), 0
+            for bound, c in zip(h.bounds, h.counts):
+                cum += c
+                lines.append(f'{name}_bucket{{{label}{sep}le="{bound}"}} {cum}')
+            lines.append(f'{name}_bucket{{{label}{sep}le="+Inf"}} {h.count}')
+            lines.append(f"{name}_sum{{{label}}} {h.sum}" if label else f"{name}_sum {h.sum}")
+            lines.append(f"{name}_count{{{label}}} {h.count}" if label else f"{name}_count {h.count}")
+
+    cpu = _proc.cpu_times()
+    metric("process_cpu_seconds_total", "counter", "CPU user+system", [("", cpu.user + cpu.system)])
+    metric("process_resident_memory_bytes", "gauge", "RSS", [("", _proc.memory_info().rss)])
+    return "\n".join(lines) + "\n"
+
+
+def status_json() -> dict:
+    cpu = _proc.cpu_times()
+    return {
+        "uptime_secs": int(clock.now() - _started),
+        "sessions": len(sessions),
+        "by_status": _status_counts(),
+        "heartbeats": {"ok": counters["hb_ok"], "fail": counters["hb_fail"]},
+        "scheduler": scheduler_stats(),
+        "log_queue": log_queue_stats(),
+        "log_store": log_store_stats(),
+        "breaker": breaker_stats(),
+        "db_flush": {**metrics["db_flush"].summary(), "rows": counters["db_flush_rows"],
+                     "errors": counters["db_flush_errors"]},
+        "latency": {k: h.summary() for k, h in list(metrics.items())},
+        "process": {"cpu_secs": cpu.user + cpu.system, "rss_bytes": _proc.memory_info().rss},
+    }
+
+
+async def _handle_metrics(request: web.Request):
+    return web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def _handle_status(request: web.Request):
+    return web.json_response(status_json())
+
+
+async def start_metrics_server(port: int = None):
+    """Chạy endpoint /metrics và /status trong cùng event loop với bot (bật bằng METRICS_PORT).
+
+    Ở chế độ nhiều process, mỗi shard gọi với port riêng (METRICS_PORT + 1 + index).
+    """
+    global _runner
+    port = METRICS_PORT if port is None else port
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    app.router.add_get("/status", _handle_status)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, port).start()
+    console_print(f"[METRICS] http://{METRICS_HOST}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+    _runner = None
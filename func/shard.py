@@ -0,0 +1,522 @@
+"""Chế độ nhiều process (SHARDS=N, mặc định 0 = chạy hết trong một process như cũ).
+
+Process chính chỉ chạy bot Discord và làm điều phối: sinh N process shard
+(python -m func.shard worker <index> <N> <port>), mỗi shard giữ các session có
+crc32(short) % N == index cùng scheduler, pool HTTP và kết nối SQLite riêng.
+Hai bên nói chuyện qua TCP 127.0.0.1, mỗi dòng một JSON:
+
+    bot   -> shard: {"id": 1, "op": "add", "args": {...}}
+    shard -> bot:   {"id": 1, "result": ...} | {"id": 1, "error": "..."}
+    shard -> bot:   {"hello": index, "secret": "..."} | {"log": "...", "level": "info"}
+
+Dòng đầu tiên của shard phải là hello kèm secret ngẫu nhiên mà bot truyền qua biến môi trường
+SHARD_SECRET lúc sinh process; kết nối khác (process lạ trên máy) bị đóng ngay, không nhận lệnh nào.
+
+Các lệnh của bot đi qua farm_*: không sharding thì gọi thẳng hàm cục bộ, có
+sharding thì gửi tới shard sở hữu key hoặc hỏi mọi shard rồi gộp kết quả.
+"""
+import os
+import sys
+import hmac
+import signal
+import json
+import asyncio
+import secrets
+import itertools
+from func import clock
+import func.state as state
+from func.state import (
+    sessions, session_snapshot, new_session, add_session, remove_session, add_log,
+    lookup_tail, tails_with_prefix, detect_tenant, short as mk_short, shard_of,
+    db_save_token, db_delete_token, db_export_tokens, log_queue_stats, breaker_stats, metrics, Histogram,
+    status_counts, counters, RETRY_POLICIES, console_print,
+)
+from func.afk import (
+    start_afk_session, stop_afk_session, scheduler_stats, import_tokens, new_import_progress, boot_forget,
+    SHUTDOWN_DRAIN,
+)
+
+SHARDS             = int(os.getenv("SHARDS", "0"))
+SHARD_CALL_TIMEOUT = 30        # giây chờ shard trả lời một lệnh
+SHARD_RESPAWN_WAIT = 3         # giây chờ trước khi chạy lại shard bị chết
+SHARD_LINE_LIMIT   = 1 << 22   # độ dài tối đa một dòng JSON
+IMPORT_KEEP        = 20        # số job nhập token đã xong còn giữ tiến độ
+
+
+class ShardError(Exception):
+    pass
+
+
+# --- Các thao tác trên session cục bộ (process đơn hoặc bên trong shard) ---
+
+async def _op_add(token: str, by: str) -> dict:
+    key = mk_short(token)
+    if key in sessions:
+        return {"error": "exists"}
+    result = await detect_tenant(token)
+    if not result:
+        return {"error": "invalid"}
+    tenant_id = result[0]
+
+    s = new_session(token, tenant_id, validated_at=clock.now())
+    if not await add_session(s):
+        return {"error": "exists"}
+    add_log(s, f"thêm bởi {by}", "success")
+    await db_save_token(key, token, tenant_id, s.added_at, s.validated_at)
+    await start_afk_session(key)
+    return {"tenant_id": tenant_id}
+
+
+async def _op_remove(key: str) -> bool:
+    if await remove_session(key) is None:
+        return False
+    boot_forget(key)
+    await db_delete_token(key)
+    return True
+
+
+async def _op_restart(key: str) -> bool:
+    if key not in sessions:
+        return False
+    await stop_afk_session(key)
+    await asyncio.sleep(1)
+    await start_afk_session(key)
+    return True
+
+
+async def _op_lookup(tail: str) -> list:
+    return lookup_tail(tail)
+
+
+async def _op_tails(prefix: str) -> list:
+    out = []
+    for t in tails_with_prefix(prefix):
+        keys = lookup_tail(t)
+        out.append([t, len(keys), sessions[keys[0]].afk_status if len(keys) == 1 else None])
+    return out
+
+
+async def _op_summary() -> dict:
+    return {
+        "total":   len(sessions),
+        "counts":  dict(status_counts),
+        "hb_ok":   counters["hb_ok"],
+        "hb_fail": counters["hb_fail"],
+    }
+
+
+async def _op_page(status: str, offset: int, limit: int) -> list:
+    """Snapshot gọn (không token, không log) của các session khớp status, từ vị trí offset."""
+    match = (s for s in list(sessions.values()) if status is None or s.afk_status == status)
+    items = []
+    for s in itertools.islice(match, offset, offset + limit):
+        snap = session_snapshot(s)
+        del snap["token"], snap["logs"]
+        items.append(snap)
+    return items
+
+
+async def _op_stats() -> dict:
+    return {
+        "scheduler": scheduler_stats(),
+        "breaker":   breaker_stats(),
+        "metrics":   {k: h.to_dict() for k, h in list(metrics.items())},
+    }
+
+
+async def _op_perf(key: str) -> dict:
+    s = sessions.get(key)
+    if s is None:
+        return None
+    return {"tail": s.token[-8:], "hb_latency": s.hb_latency.to_dict(),
+            "hb_drift": s.hb_drift.to_dict(), "retries": s.retries}
+
+
+_imports: dict[int, dict] = {}  # job nhập token -> tiến độ
+_import_ids = itertools.count(1)
+
+
+async def _op_import(tokens: list, by: str) -> int:
+    for old in [j for j, p in _imports.items() if p["done"]][:-IMPORT_KEEP]:
+        del _imports[old]
+    job = next(_import_ids)
+    _imports[job] = progress = new_import_progress(len(tokens))
+    asyncio.create_task(import_tokens(tokens, by, progress))
+    return job
+
+
+async def _op_import_status(job: int) -> dict:
+    return _imports.get(job)
+
+
+_OPS = {
+    "add":           _op_add,
+    "remove":        _op_remove,
+    "restart":       _op_restart,
+    "lookup":        _op_lookup,
+    "tails":         _op_tails,
+    "summary":       _op_summary,
+    "page":          _op_page,
+    "stats":         _op_stats,
+    "perf":          _op_perf,
+    "import":        _op_import,
+    "import_status": _op_import_status,
+}
+
+
+# --- Phía bot: điều phối ---
+
+_conns: dict[int, asyncio.StreamWriter] = {}
+_ready: dict[int, asyncio.Event] = {}
+_procs: dict[int, asyncio.subprocess.Process] = {}
+_pending: dict[int, asyncio.Future] = {}
+_ids = itertools.count(1)
+_server: asyncio.AbstractServer = None
+_tasks: list = []
+_stopping = False
+_secret = secrets.token_hex(32)  # shard phải gửi kèm trong hello
+
+
+async def _on_shard_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    index = None
+    try:
+        hello = json.loads(await asyncio.wait_for(reader.readline(), timeout=SHARD_CALL_TIMEOUT) or b"{}")
+        if (not hmac.compare_digest(str(hello.get("secret", "")), _secret)
+                or hello.get("hello") not in _ready):
+            console_print(f"[SHARD] từ chối kết nối lạ từ {writer.get_extra_info('peername')}")
+            return
+        index = hello["hello"]
+        _conns[index] = writer
+        _ready[index].set()
+        console_print(f"[SHARD] shard {index} đã kết nối")
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            msg = json.loads(line)
+            if "log" in msg:
+                state.relay_log(msg["log"], msg["level"])
+            else:
+                fut = _pending.pop(msg["id"], None)
+                if fut is not None and not fut.done():
+                    if "error" in msg:
+                        fut.set_exception(ShardError(msg["error"]))
+                    else:
+                        fut.set_result(msg["result"])
+    except Exception as e:
+        console_print(f"[SHARD] lỗi đọc từ shard {index}: {e}")
+    finally:
+        if index is not None and _conns.get(index) is writer:
+            del _conns[index]
+            _ready[index].clear()
+        writer.close()
+
+
+async def _spawn(index: int, port: int):
+    _procs[index] = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "func.shard", "worker", str(index), str(SHARDS), str(port),
+        env={**os.environ, "SHARD_SECRET": _secret},  # không đưa vào argv — ps của user khác đọc được
+    )
+
+
+async def _supervise(index: int, port: int):
+    """Theo dõi một shard, chạy lại nếu nó chết ngoài ý muốn."""
+    while not _stopping:
+        await _spawn(index, port)
+        code = await _procs[index].wait()
+        if _stopping:
+            break
+        console_print(f"[SHARD] shard {index} thoát với mã {code} — chạy lại sau {SHARD_RESPAWN_WAIT}s")
+        await asyncio.sleep(SHARD_RESPAWN_WAIT)
+
+
+async def start_shards():
+    global _server
+    _server = await asyncio.start_server(_on_shard_connect, "127.0.0.1", 0, limit=SHARD_LINE_LIMIT)
+    port = _server.sockets[0].getsockname()[1]
+    for i in range(SHARDS):
+        _ready[i] = asyncio.Event()
+        _tasks.append(asyncio.create_task(_supervise(i, port)))
+    console_print(f"[SHARD] {SHARDS} shard, điều phối tại 127.0.0.1:{port}")
+
+
+async def stop_shards():
+    """Báo mọi shard tắt (ghi stats lần cuối), quá hạn thì kill."""
+    global _stopping
+    _stopping = True
+    for w in list(_conns.values()):
+        try:
+            w.write(b'{"op": "shutdown"}\n')
+        except Exception:
+            pass
+    for i, proc in list(_procs.items()):
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=SHUTDOWN_DRAIN + 15)
+        except asyncio.TimeoutError:
+            console_print(f"[SHARD] shard {i} không tắt kịp — kill")
+            proc.kill()
+    for t in _tasks:
+        t.cancel()
+    if _server is not None:
+        _server.close()
+
+
+async def _call(index: int, op: str, timeout: float = SHARD_CALL_TIMEOUT, **args):
+    try:
+        await asyncio.wait_for(_ready[index].wait(), timeout=SHARD_CALL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise ShardError(f"shard {index} chưa sẵn sàng")
+    rid = next(_ids)
+    fut = asyncio.get_running_loop().create_future()
+    _pending[rid] = fut
+    try:
+        _conns[index].write(json.dumps({"id": rid, "op": op, "args": args}).encode() + b"\n")
+        return await asyncio.wait_for(fut, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise ShardError(f"shard {index} không trả lời")
+    finally:
+        _pending.pop(rid, None)
+
+
+async def _call_key(key: str, op: str, **args):
+    if not SHARDS:
+        return await _OPS[op](key, **args)
+    return await _call(shard_of(key, SHARDS), op, key=key, **args)
+
+
+async def _call_each(op: str, **args) -> dict:
+    """Gọi op trên mọi shard đang sống, trả {index: kết quả}; shard lỗi/chưa lên bị bỏ qua."""
+    if not SHARDS:
+        return {0: await _OPS[op](**args)}
+    live    = [i for i in range(SHARDS) if i in _conns]  # không chờ shard đang khởi động lại
+    results = await asyncio.gather(*[_call(i, op, **args) for i in live], return_exceptions=True)
+    return {i: r for i, r in zip(live, results) if not isinstance(r, BaseException)}
+
+
+async def _call_all(op: str, **args) -> list:
+    return list((await _call_each(op, **args)).values())
+
+
+async def farm_add(token: str, by: str) -> dict:
+    if not SHARDS:
+        return await _op_add(token, by)
+    # add chờ detect_tenant với đủ lượt retry — không báo "không phản hồi" khi shard vẫn đang thêm token
+    return await _call(shard_of(mk_short(token), SHARDS), "add",
+                       timeout=RETRY_POLICIES["tenants"].budget + SHARD_CALL_TIMEOUT, token=token, by=by)
+
+
+async def farm_remove(key: str) -> bool:
+    return await _call_key(key, "remove")
+
+
+async def farm_restart(key: str) -> bool:
+    return await _call_key(key, "restart")
+
+
+async def farm_perf(key: str) -> dict:
+    r = await _call_key(key, "perf")
+    if r is not None:
+        r["hb_latency"] = Histogram.from_dict(r["hb_latency"])
+        r["hb_drift"]   = Histogram.from_dict(r["hb_drift"])
+    return r
+
+
+async def farm_lookup(tail: str) -> list:
+    return [k for keys in await _call_all("lookup", tail=tail) for k in keys]
+
+
+async def farm_tails(prefix: str, limit: int = 25) -> list:
+    """[(tail, số token trùng tail, trạng thái nếu chỉ một token)] sắp theo tail."""
+    merged: dict[str, list] = {}
+    for part in await _call_all("tails", prefix=prefix):
+        for t, n, status in part:
+            if t in merged:
+                merged[t] = [merged[t][0] + n, None]
+            else:
+                merged[t] = [n, status]
+    return [(t, n, st) for t, (n, st) in sorted(merged.items())[:limit]]
+
+
+def _merge_summary(parts) -> dict:
+    out = {"total": 0, "counts": {}, "hb_ok": 0, "hb_fail": 0}
+    for p in parts:
+        out["total"]   += p["total"]
+        out["hb_ok"]   += p["hb_ok"]
+        out["hb_fail"] += p["hb_fail"]
+        for st, n in p["counts"].items():
+            out["counts"][st] = out["counts"].get(st, 0) + n
+    return out
+
+
+async def farm_summary() -> dict:
+    """Tổng số session theo trạng thái và tổng HB — đọc bộ đếm sẵn có, không quét session."""
+    return _merge_summary(await _call_all("summary"))
+
+
+async def farm_page(status: str, page: int, per_page: int) -> dict:
+    """Một trang session (lọc theo status nếu có). Thứ tự: shard 0 trước, trong shard theo thứ tự thêm."""
+    per     = await _call_each("summary")
+    summary = _merge_summary(per.values())
+    offset  = page * per_page
+    items: list = []
+    for i in sorted(per):
+        n = per[i]["counts"].get(status, 0) if status else per[i]["total"]
+        if offset >= n:
+            offset -= n
+            continue
+        want = per_page - len(items)
+        if SHARDS:
+            items += await _call(i, "page", status=status, offset=offset, limit=want)
+        else:
+            items += await _op_page(status, offset, want)
+        offset = 0
+        if len(items) >= per_page:
+            break
+    total = summary["counts"].get(status, 0) if status else summary["total"]
+    return {"summary": summary, "total": total, "items": items}
+
+
+async def farm_import(tokens: list, by: str) -> list:
+    """Bắt đầu nhập token; mỗi shard nhận phần token của mình. Trả [(shard, job)] để hỏi tiến độ."""
+    if not SHARDS:
+        return [(None, await _op_import(tokens, by))]
+    parts: dict[int, list] = {}
+    for t in tokens:
+        parts.setdefault(shard_of(mk_short(t), SHARDS), []).append(t)
+    return [(i, await _call(i, "import", tokens=part, by=by)) for i, part in parts.items()]
+
+
+async def farm_import_status(jobs: list) -> dict:
+    total = new_import_progress(0)
+    total["done"] = True
+    for i, job in jobs:
+        try:
+            p = await (_op_import_status(job) if i is None else _call(i, "import_status", job=job))
+        except ShardError as e:
+            p = {"done": True, "error": str(e)}
+        if p is None:
+            continue
+        for k in ("lines", "dup", "checked", "invalid", "saved", "started", "to_check"):
+            total[k] += p.get(k, 0)
+        total["done"]  = total["done"] and p["done"]
+        total["error"] = total["error"] or p["error"]
+    return total
+
+
+async def farm_export(path: str) -> int:
+    """Token nằm chung một DB nên process nào cũng đọc được, không cần hỏi shard."""
+    return await db_export_tokens(path)
+
+
+_BREAKER_RANK = {"closed": 0, "half_open": 1, "open": 2}
+
+
+async def farm_stats() -> dict:
+    """Số liệu scheduler/breaker/histogram gộp từ mọi shard; log queue là của process bot."""
+    if not SHARDS:
+        return {"scheduler": scheduler_stats(), "breaker": breaker_stats(),
+                "log_queue": log_queue_stats(), "metrics": metrics}
+    parts = await _call_all("stats")
+    sch = {"pending": 0, "queued": 0, "running": 0, "fired": 0, "late_last": 0.0, "late_avg": 0.0, "late_max": 0.0}
+    brk = {"state": "closed", "fails": 0, "trips": 0, "rejected": 0, "rate": 0.0, "waited": 0.0}
+    hists = {k: Histogram(h.bounds) for k, h in metrics.items()}
+    for p in parts:
+        for k in ("pending", "queued", "running", "fired"):
+            sch[k] += p["scheduler"][k]
+        sch["late_last"] = max(sch["late_last"], p["scheduler"]["late_last"])
+        sch["late_max"]  = max(sch["late_max"], p["scheduler"]["late_max"])
+        sch["late_avg"] += p["scheduler"]["late_avg"] / len(parts)
+        b = p["breaker"]
+        if _BREAKER_RANK[b["state"]] > _BREAKER_RANK[brk["state"]]:
+            brk["state"] = b["state"]
+        for k in ("fails", "trips", "rejected", "rate", "waited"):
+            brk[k] += b[k]
+        for name, d in p["metrics"].items():
+            h = Histogram.from_dict(d)
+            if name in hists:
+                hists[name].merge(h)
+            else:
+                hists[name] = h
+    hists["loop_lag_bot"] = metrics["loop_lag"]
+    return {"scheduler": sch, "breaker": brk, "log_queue": log_queue_stats(), "metrics": hists}
+
+
+# --- Phía shard ---
+
+async def _serve(index: int, reader: asyncio.StreamReader, send):
+    async def _handle(msg):
+        try:
+            result = await _OPS[msg["op"]](**msg["args"])
+            send({"id": msg["id"], "result": result})
+        except Exception as e:
+            send({"id": msg["id"], "error": f"{type(e).__name__}: {e}"[:300]})
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            console_print(f"[SHARD {index}] mất kết nối tới bot — tắt")
+            return
+        msg = json.loads(line)
+        if msg.get("op") == "shutdown":
+            return
+        asyncio.create_task(_handle(msg))
+
+
+async def worker_main(index: int, count: int, port: int):
+    from func.state import (
+        db_init, db_load_lifetime, db_close, close_http, start_loop_monitor, set_log_forward,
+        start_log_store, stop_log_store,
+    )
+    from func.afk import (
+        load_all_tokens, start_stats_flusher, stop_scheduler, stop_stats_flusher,
+        checkpoint_sessions,
+    )
+    from func.metrics import METRICS_PORT, start_metrics_server, stop_metrics_server
+
+    state.SHARD_INDEX, state.SHARD_COUNT = index, count
+    # cả farm vẫn chung một ngân sách request tới Altare
+    state.API_RATE  /= count
+    state.API_BURST  = max(state.API_BURST / count, 1.0)
+
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+
+    await db_init()
+    await db_load_lifetime()
+    start_log_store()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=SHARD_LINE_LIMIT)
+
+    def send(msg: dict):
+        if not writer.is_closing():
+            writer.write(json.dumps(msg, ensure_ascii=False).encode() + b"\n")
+
+    set_log_forward(lambda line, level: send({"log": line, "level": level}))
+    send({"hello": index, "secret": os.environ.pop("SHARD_SECRET", "")})
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + 1 + index)
+    start_stats_flusher()
+    start_loop_monitor()
+    boot = asyncio.create_task(load_all_tokens())
+    try:
+        await _serve(index, reader, send)
+    finally:
+        boot.cancel()
+        await stop_scheduler(SHUTDOWN_DRAIN)
+        await stop_stats_flusher()
+        await checkpoint_sessions()
+        await stop_log_store()
+        await stop_metrics_server()
+        await close_http()
+        await db_close()
+        writer.close()
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["worker"]:
+    # biến môi trường (.env) đã được process bot nạp và truyền xuống
+    _, _, i, n, p = sys.argv
+    try:
+        asyncio.run(worker_main(int(i), int(n), int(p)))
+    except asyncio.CancelledError:
+        pass  # SIGTERM: đã tắt êm trong worker_main
@@ -1,9 +1,16 @@
+import os
+import zlib
+import bisect
+import random
 import asyncio
-import time
 import sqlite3
+import threading
 import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import datetime
-from typing import Optional
+from typing import NamedTuple, Optional
+from func import clock
 
 BASE = "https://api.altare.sh"
 HEADERS_BASE = {
@@ -15,124 +22,655 @@ HEADERS_BASE = {
 }
 DB_PATH = "altare.db"
 
-sessions: dict[str, dict] = {}
-lock = asyncio.Lock()
+# Chuỗi thời gian hb_series: độ phân giải và thời gian giữ bucket thô
+SERIES_MINUTE       = 60
+SERIES_HOUR         = 3600
+SERIES_DAY          = 86400
+SERIES_KEEP_MINUTES = int(os.getenv("SERIES_KEEP_MINUTES", str(2 * 86400)))   # giây giữ bucket phút
+SERIES_KEEP_HOURS   = int(os.getenv("SERIES_KEEP_HOURS", str(60 * 86400)))    # giây giữ bucket giờ
+
+# Pool kết nối HTTP dùng chung
+HTTP_LIMIT          = int(os.getenv("HTTP_LIMIT", "100"))          # tổng số kết nối tối đa
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "50"))  # kết nối tối đa tới api.altare.sh
+HTTP_DNS_TTL        = 300  # giây cache DNS
+HTTP_KEEPALIVE      = 60   # giây giữ kết nối rảnh
+HTTP_TRACE_CONFIGS: list = []  # aiohttp.TraceConfig gắn vào client dùng chung (bench/đo đạc)
+
+# Cache tenant_id: tin giá trị trong DB trong TENANT_TTL giây kể từ lần kiểm tra cuối
+TENANT_TTL          = int(os.getenv("TENANT_TTL", str(7 * 86400)))
+TENANT_RECHECK_MIN  = 300              # giây tối thiểu giữa hai lần kiểm tra lại một token khi gặp lỗi
+TENANT_ERROR_STATUS = (401, 403, 404)  # mã lỗi cho thấy token/tenant có thể đã đổi
+
+sessions: dict[str, "Session"] = {}
+# Chỉ dùng khi thêm/xóa session; trạng thái từng session được bảo vệ bởi s.lock riêng
+registry_lock = asyncio.Lock()
+
+# Chỉ mục tail (8 ký tự cuối token) -> các key session; danh sách tail sắp xếp để tra prefix
+TAIL_LEN = 8
+_tail_index: dict[str, set[str]] = {}
+_tail_sorted: list[str] = []
+
+# Chế độ nhiều process: process này chỉ giữ các session có shard_of(key) == SHARD_INDEX
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+
+# Số session đang đăng ký theo afk_status — cập nhật qua set_status/add_session/remove_session
+status_counts: dict[str, int] = {}
+
+# Cache lifetime_stats trong RAM: nạp một lần lúc boot, ghi xuyên qua khi flush stats
+lifetime: dict[str, dict] = {}
+
+_http: Optional[aiohttp.ClientSession] = None
+
+# Một luồng DB riêng giữ kết nối SQLite sống suốt process
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_db: Optional[sqlite3.Connection] = None  # chỉ truy cập từ luồng DB
 
 # Kênh Discord để gửi log — được set sau khi bot sẵn sàng
+LOG_QUEUE_MAX   = int(os.getenv("LOG_QUEUE_MAX", "2000"))  # số dòng chờ tối đa mỗi lane
+LOG_LAG_WARN    = 30    # giây — tin nhắn có dòng chờ lâu hơn thì tính là trễ
+DISCORD_MSG_MAX = 2000  # giới hạn ký tự một tin nhắn Discord
+
+LOG_LEVEL       = os.getenv("LOG_LEVEL", "info").lower()  # bỏ qua các dòng dưới mức này
+
+# Lưu log xuống bảng logs: dòng vào bộ đệm, ghi theo lô trên luồng DB
+LOG_STORE_MAX      = 20000  # số dòng chờ ghi tối đa — đầy thì bỏ dòng cũ nhất
+LOG_STORE_BATCH    = 500    # số dòng mỗi câu INSERT
+LOG_STORE_INTERVAL = 2      # giây giữa các lần ghi
+LOG_KEEP_SECS      = int(os.getenv("LOG_KEEP_SECS", str(14 * 86400)))  # giây giữ log trong DB
+LOG_KEEP_ROWS      = int(os.getenv("LOG_KEEP_ROWS", "1000000"))      # số dòng log tối đa trong DB
+LOG_PRUNE_INTERVAL = 600    # giây giữa các lần xóa log hết hạn
+
 _log_channel = None
-_log_queue: asyncio.Queue = None
+_log_wake: asyncio.Event = None
+# Hai lane có giới hạn: warn/error được gửi trước. Phần tử: (thời điểm vào hàng, dòng log)
+_log_lines:  deque = deque(maxlen=LOG_QUEUE_MAX)
+_log_urgent: deque = deque(maxlen=LOG_QUEUE_MAX)
+_log_stats = {"sent_msgs": 0, "sent_lines": 0, "dropped": 0, "lagged": 0, "max_lag": 0.0}
+_log_forward = None  # process shard: chuyển dòng log về process bot thay vì tự gửi Discord
+
+# Phần tử: (epoch, tail, level, msg). None = chưa bật lưu log (process bot khi chạy nhiều shard)
+_log_store: Optional[deque] = None
+_log_store_task: asyncio.Task = None
+_log_store_stats = {"stored": 0, "dropped": 0, "errors": 0, "console_dropped": 0}
+
+# In console trên luồng riêng: stdout chậm (pipe, journald) không chặn event loop
+_console: deque = deque(maxlen=LOG_STORE_MAX)
+_console_wake = threading.Condition()
+_console_thread: Optional[threading.Thread] = None
+_console_busy = False  # luồng console đang in một lô đã lấy ra
 
 
 def set_log_channel(channel):
-    global _log_channel, _log_queue
+    global _log_channel, _log_wake
     _log_channel = channel
-    _log_queue = asyncio.Queue()
-    asyncio.create_task(_log_sender())
+    if _log_wake is None:
+        _log_wake = asyncio.Event()
+        asyncio.create_task(_log_sender())
+
+
+def set_log_forward(fn):
+    global _log_forward
+    _log_forward = fn
+
+
+def _enqueue_log(line: str, level: str):
+    if _log_forward is not None:
+        _log_forward(line, level)
+        return
+    if _log_wake is None:
+        return
+    lane = _log_urgent if level in ("warn", "error") else _log_lines
+    if len(lane) == lane.maxlen:
+        _log_stats["dropped"] += 1  # deque(maxlen) sẽ đẩy dòng cũ nhất ra
+    lane.append((clock.monotonic(), line))
+    _log_wake.set()
+
+
+def _pack_log_message() -> tuple[str, float]:
+    """Gom nhiều dòng chờ nhất có thể vào một tin nhắn ≤ DISCORD_MSG_MAX ký tự."""
+    parts, size, oldest = [], 0, None
+    for lane in (_log_urgent, _log_lines):
+        while lane:
+            ts, line = lane[0]
+            line = line[:DISCORD_MSG_MAX]
+            # dòng đầu luôn được lấy (đã cắt vừa một tin nhắn) để hàng đợi chắc chắn vơi đi
+            if parts and size + len(line) > DISCORD_MSG_MAX:
+                return "\n".join(parts), oldest
+            lane.popleft()
+            parts.append(line)
+            size += len(line) + 1
+            oldest = ts if oldest is None else min(oldest, ts)
+    return "\n".join(parts), oldest
 
 
 async def _log_sender():
-    """Gửi log lên Discord channel theo hàng đợi, tránh rate limit."""
+    """Gửi log lên Discord, gộp nhiều dòng vào một tin nhắn.
+
+    discord.py tự đọc header X-RateLimit-* và chờ đúng bucket, nên không cần sleep cố định;
+    chỉ khi nó bỏ cuộc (RateLimited/429) mới chờ theo retry_after.
+    """
     while True:
         try:
-            msg = await _log_queue.get()
+            if not _log_urgent and not _log_lines:
+                _log_wake.clear()
+                await _log_wake.wait()
+            msg, oldest = _pack_log_message()
+            if not msg:
+                continue
+            lag = clock.monotonic() - oldest
+            n   = msg.count("\n") + 1
+            _log_stats["max_lag"] = max(_log_stats["max_lag"], lag)
+            if lag > LOG_LAG_WARN:
+                _log_stats["lagged"] += 1
             if _log_channel:
                 try:
                     await _log_channel.send(msg)
+                    _log_stats["sent_msgs"]  += 1
+                    _log_stats["sent_lines"] += n
                 except Exception as e:
-                    print(f"[LOG-SEND] lỗi gửi channel: {e}")
-            _log_queue.task_done()
-            await asyncio.sleep(0.6)  # ~100 msg/phút, an toàn với rate limit Discord
+                    _log_stats["dropped"] += n
+                    console_print(f"[LOG-SEND] lỗi gửi channel: {e}")
+                    retry_after = getattr(e, "retry_after", None)
+                    if retry_after:
+                        await asyncio.sleep(retry_after)
         except Exception:
             await asyncio.sleep(1)
 
 
-def _conn():
-    for _ in range(5):
+def _console_writer():
+    global _console_busy
+    while True:
+        with _console_wake:
+            _console_busy = False
+            _console_wake.notify_all()  # báo flush_console khi đã in hết
+            while not _console:
+                _console_wake.wait()
+            lines = list(_console)
+            _console.clear()
+            _console_busy = True
+        print("\n".join(lines), flush=True)
+
+
+def console_print(line: str):
+    global _console_thread
+    with _console_wake:
+        if _console_thread is None:
+            _console_thread = threading.Thread(target=_console_writer, name="console", daemon=True)
+            _console_thread.start()
+        if len(_console) == _console.maxlen:
+            _log_store_stats["console_dropped"] += 1
+        _console.append(line)
+        _console_wake.notify_all()
+
+
+def flush_console(timeout: float = 2.0):
+    """Chờ luồng console in hết các dòng đang chờ (gọi lúc tắt)."""
+    with _console_wake:
+        if _console_thread is not None:
+            _console_wake.wait_for(lambda: not _console and not _console_busy, timeout)
+
+
+def relay_log(line: str, level: str):
+    """Nhận dòng log đã format từ process shard, đưa vào hàng đợi gửi Discord."""
+    _enqueue_log(line, level)
+
+
+def log_queue_stats() -> dict:
+    return {
+        "pending": len(_log_lines),
+        "urgent":  len(_log_urgent),
+        **_log_stats,
+    }
+
+
+async def _flush_log_store():
+    while _log_store:
+        batch = [_log_store.popleft() for _ in range(min(len(_log_store), LOG_STORE_BATCH))]
         try:
-            c = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=15.0)
-            c.row_factory = sqlite3.Row
-            c.execute("PRAGMA journal_mode=WAL")
-            c.execute("PRAGMA synchronous=NORMAL")
-            return c
-        except sqlite3.OperationalError:
-            time.sleep(0.5)
-    raise RuntimeError("Không thể kết nối DB")
-
-
-def db_init():
-    with _conn() as c:
-        c.executescript("""
-        CREATE TABLE IF NOT EXISTS tokens (
-            short TEXT PRIMARY KEY,
-            token TEXT NOT NULL,
-            tenant_id TEXT NOT NULL,
-            added_at REAL NOT NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS lifetime_stats (
-            short TEXT PRIMARY KEY,
-            total_hb_ok INTEGER DEFAULT 0,
-            total_hb_fail INTEGER DEFAULT 0,
-            total_uptime_secs INTEGER DEFAULT 0,
-            first_seen REAL NOT NULL
-        );
-        """)
-
-
-def db_save_token(short: str, token: str, tenant_id: str, added_at: float):
+            await _db_run(lambda c: c.executemany(_SQL_ADD_LOG, batch))
+            _log_store_stats["stored"] += len(batch)
+        except Exception as e:
+            _log_store_stats["errors"] += len(batch)
+            console_print(f"[LOG-STORE] lỗi ghi {len(batch)} dòng: {e}")
+            return
+
+
+async def _log_store_writer():
+    last_prune = None
     try:
-        with _conn() as c:
-            c.execute(
-                "INSERT OR REPLACE INTO tokens (short, token, tenant_id, added_at) VALUES (?, ?, ?, ?)",
-                (short, token, tenant_id, added_at)
-            )
-            c.execute(
-                "INSERT OR IGNORE INTO lifetime_stats (short, first_seen) VALUES (?, ?)",
-                (short, added_at)
-            )
+        while True:
+            await asyncio.sleep(LOG_STORE_INTERVAL)
+            await _flush_log_store()
+            if SHARD_INDEX == 0 and (last_prune is None or clock.monotonic() - last_prune >= LOG_PRUNE_INTERVAL):
+                last_prune = clock.monotonic()
+                try:
+                    await db_prune_logs()
+                except Exception as e:
+                    console_print(f"[LOG-STORE] lỗi xóa log cũ: {e}")
+    except asyncio.CancelledError:
+        await _flush_log_store()  # lần ghi cuối khi tắt
+        raise
+
+
+def start_log_store():
+    """Bắt đầu lưu log vào DB (gọi sau db_init)."""
+    global _log_store, _log_store_task
+    if _log_store is None:
+        _log_store = deque(maxlen=LOG_STORE_MAX)
+    if _log_store_task is None or _log_store_task.done():
+        _log_store_task = asyncio.create_task(_log_store_writer())
+
+
+async def stop_log_store():
+    """Ghi nốt log đang chờ, rồi chờ console in xong."""
+    global _log_store_task
+    if _log_store_task is not None and not _log_store_task.done():
+        _log_store_task.cancel()
+        try:
+            await _log_store_task
+        except asyncio.CancelledError:
+            pass
+    _log_store_task = None
+    flush_console()
+
+
+def log_store_stats() -> dict:
+    return {"pending": len(_log_store) if _log_store is not None else 0, **_log_store_stats}
+
+
+def get_http() -> aiohttp.ClientSession:
+    """Client HTTP dùng chung cho cả process — giữ kết nối keep-alive, cache DNS."""
+    global _http
+    if _http is None or _http.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+        )
+        _http = aiohttp.ClientSession(connector=connector, trace_configs=HTTP_TRACE_CONFIGS or None)
+    return _http
+
+
+async def close_http():
+    global _http
+    if _http is not None and not _http.closed:
+        await _http.close()
+    _http = None
+
+
+def _db_open() -> sqlite3.Connection:
+    c = sqlite3.connect(DB_PATH, timeout=15.0, cached_statements=256)
+    c.row_factory = sqlite3.Row
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    return c
+
+
+def _db_call(fn, args):
+    """Chạy trên luồng DB: dùng lại một kết nối duy nhất, mỗi lệnh gọi là một transaction."""
+    global _db
+    if _db is None:
+        _db = _db_open()
+    with _db:
+        return fn(_db, *args)
+
+
+async def _db_run(fn, *args):
+    """Đẩy fn(conn, *args) sang luồng DB riêng để event loop không bị chặn bởi I/O đĩa."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _db_call, fn, args)
+
+
+# Câu lệnh SQL cố định — sqlite3 cache bản đã biên dịch theo kết nối
+_SQL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    short TEXT PRIMARY KEY,
+    token TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    added_at REAL NOT NULL,
+    validated_at REAL
+);
+
+CREATE TABLE IF NOT EXISTS lifetime_stats (
+    short TEXT PRIMARY KEY,
+    total_hb_ok INTEGER DEFAULT 0,
+    total_hb_fail INTEGER DEFAULT 0,
+    total_uptime_secs INTEGER DEFAULT 0,
+    first_seen REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+    short TEXT PRIMARY KEY,
+    tenant_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    cycle INTEGER NOT NULL,
+    cycle_start REAL,
+    farm_start REAL,
+    hb_ok INTEGER NOT NULL,
+    hb_fail INTEGER NOT NULL,
+    hb_count INTEGER NOT NULL,
+    saved_at REAL NOT NULL
+);
+
+-- Chuỗi thời gian delta heartbeat mỗi session. res = độ dài bucket (60 / 3600 / 86400 giây),
+-- bucket = epoch đầu bucket. Phút được gộp lên giờ, giờ lên ngày; rolled_until ghi mốc đã gộp.
+CREATE TABLE IF NOT EXISTS hb_series (
+    short TEXT NOT NULL,
+    res INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    hb_ok INTEGER NOT NULL DEFAULT 0,
+    hb_fail INTEGER NOT NULL DEFAULT 0,
+    uptime_secs INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (short, res, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_hb_series_res_bucket ON hb_series (res, bucket);
+
+CREATE TABLE IF NOT EXISTS hb_series_rollup (
+    res INTEGER PRIMARY KEY,
+    rolled_until INTEGER NOT NULL
+);
+
+-- Log của add_log/add_farm_log. tail = 8 ký tự cuối token, "farm" cho log chung
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    tail TEXT NOT NULL,
+    level TEXT NOT NULL,
+    msg TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs (ts);
+CREATE INDEX IF NOT EXISTS idx_logs_tail_ts ON logs (tail, ts);
+"""
+_SQL_SAVE_TOKEN     = """
+    INSERT OR REPLACE INTO tokens (short, token, tenant_id, added_at, validated_at) VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_SET_TENANT     = "UPDATE tokens SET tenant_id=?, validated_at=? WHERE short=?"
+_SQL_INIT_LIFETIME  = "INSERT OR IGNORE INTO lifetime_stats (short, first_seen) VALUES (?, ?)"
+_SQL_DELETE_TOKEN   = "DELETE FROM tokens WHERE short=?"
+_SQL_LOAD_TOKENS    = "SELECT * FROM tokens"
+_SQL_EXPORT_TOKENS  = "SELECT token FROM tokens ORDER BY added_at"
+_SQL_UPDATE_LIFETIME = """
+    INSERT INTO lifetime_stats (short, total_hb_ok, total_hb_fail, total_uptime_secs, first_seen)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(short) DO UPDATE SET
+        total_hb_ok = total_hb_ok + excluded.total_hb_ok,
+        total_hb_fail = total_hb_fail + excluded.total_hb_fail,
+        total_uptime_secs = total_uptime_secs + excluded.total_uptime_secs
+"""
+_SQL_ADD_SERIES = """
+    INSERT INTO hb_series (short, res, bucket, hb_ok, hb_fail, uptime_secs) VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(short, res, bucket) DO UPDATE SET
+        hb_ok = hb_ok + excluded.hb_ok,
+        hb_fail = hb_fail + excluded.hb_fail,
+        uptime_secs = uptime_secs + excluded.uptime_secs
+"""
+_SQL_ROLLUP_SERIES = """
+    INSERT INTO hb_series (short, res, bucket, hb_ok, hb_fail, uptime_secs)
+    SELECT short, :to_res, bucket - bucket % :to_res, SUM(hb_ok), SUM(hb_fail), SUM(uptime_secs)
+    FROM hb_series WHERE res = :from_res AND bucket >= :since AND bucket < :until
+    GROUP BY short, bucket - bucket % :to_res
+    ON CONFLICT(short, res, bucket) DO UPDATE SET
+        hb_ok = hb_ok + excluded.hb_ok,
+        hb_fail = hb_fail + excluded.hb_fail,
+        uptime_secs = uptime_secs + excluded.uptime_secs
+"""
+_SQL_PRUNE_SERIES   = "DELETE FROM hb_series WHERE res=? AND bucket<?"
+_SQL_GET_ROLLUP     = "SELECT rolled_until FROM hb_series_rollup WHERE res=?"
+_SQL_SET_ROLLUP     = "INSERT OR REPLACE INTO hb_series_rollup (res, rolled_until) VALUES (?, ?)"
+_SQL_LOAD_LIFETIME  = "SELECT * FROM lifetime_stats"
+_SQL_SAVE_CHECKPOINT = """
+    INSERT OR REPLACE INTO checkpoints
+        (short, tenant_id, status, cycle, cycle_start, farm_start, hb_ok, hb_fail, hb_count, saved_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_LOAD_CHECKPOINTS  = "SELECT * FROM checkpoints"
+_SQL_ADD_LOG           = "INSERT INTO logs (ts, tail, level, msg) VALUES (?, ?, ?, ?)"
+_SQL_PRUNE_LOGS_AGE    = "DELETE FROM logs WHERE ts<?"
+_SQL_PRUNE_LOGS_ROWS   = "DELETE FROM logs WHERE id <= (SELECT MAX(id) FROM logs) - ?"
+_SQL_DELETE_CHECKPOINT = "DELETE FROM checkpoints WHERE short=?"
+
+
+def _migrate(c: sqlite3.Connection):
+    cols = {r["name"] for r in c.execute("PRAGMA table_info(tokens)")}
+    if "validated_at" not in cols:
+        c.execute("ALTER TABLE tokens ADD COLUMN validated_at REAL")
+
+
+async def db_init():
+    def _q(c):
+        c.executescript(_SQL_SCHEMA)
+        _migrate(c)
+    await _db_run(_q)
+
+
+async def db_close():
+    def _close():
+        global _db
+        if _db is not None:
+            _db.close()
+            _db = None
+    await asyncio.get_running_loop().run_in_executor(_db_executor, _close)
+
+
+def _lifetime_add(short: str, hb_ok: int, hb_fail: int, uptime_delta: int):
+    lt = lifetime.get(short)
+    if lt is None:
+        lt = lifetime[short] = {"total_hb_ok": 0, "total_hb_fail": 0, "total_uptime_secs": 0}
+    lt["total_hb_ok"]       += hb_ok
+    lt["total_hb_fail"]     += hb_fail
+    lt["total_uptime_secs"] += uptime_delta
+
+
+async def db_load_lifetime():
+    """Nạp toàn bộ lifetime_stats vào cache `lifetime` bằng một câu SELECT."""
+    try:
+        rows = await _db_run(lambda c: c.execute(_SQL_LOAD_LIFETIME).fetchall())
     except Exception as e:
-        print(f"[DB] save_token: {e}")
+        console_print(f"[DB] load_lifetime: {e}")
+        return
+    lifetime.clear()
+    for r in rows:
+        lifetime[r["short"]] = {
+            "total_hb_ok": r["total_hb_ok"],
+            "total_hb_fail": r["total_hb_fail"],
+            "total_uptime_secs": r["total_uptime_secs"],
+        }
 
 
-def db_delete_token(short: str):
+async def db_save_token(short: str, token: str, tenant_id: str, added_at: float,
+                        validated_at: float = None):
+    def _q(c):
+        c.execute(_SQL_SAVE_TOKEN, (short, token, tenant_id, added_at, validated_at))
+        c.execute(_SQL_INIT_LIFETIME, (short, added_at))
     try:
-        with _conn() as c:
-            c.execute("DELETE FROM tokens WHERE short=?", (short,))
+        await _db_run(_q)
+        _lifetime_add(short, 0, 0, 0)
     except Exception as e:
-        print(f"[DB] delete_token: {e}")
+        console_print(f"[DB] save_token: {e}")
 
 
-def db_load_tokens():
+async def db_save_tokens_many(rows: list) -> bool:
+    """Ghi nhiều token trong một transaction. rows: [(short, token, tenant_id, added_at, validated_at)]."""
+    def _q(c):
+        c.executemany(_SQL_SAVE_TOKEN, rows)
+        c.executemany(_SQL_INIT_LIFETIME, [(r[0], r[3]) for r in rows])
     try:
-        with _conn() as c:
-            return c.execute("SELECT * FROM tokens").fetchall()
+        await _db_run(_q)
     except Exception as e:
-        print(f"[DB] load_tokens: {e}")
-        return []
+        console_print(f"[DB] save_tokens_many: {e}")
+        return False
+    for r in rows:
+        _lifetime_add(r[0], 0, 0, 0)
+    return True
 
 
-def db_update_lifetime(short: str, hb_ok: int, hb_fail: int, uptime_delta: int):
+async def db_export_tokens(path: str, batch: int = 500) -> int:
+    """Ghi toàn bộ token ra file, mỗi dòng một token; đọc từng lô trên luồng DB. Trả số token."""
+    def _q(c):
+        n = 0
+        cur = c.execute(_SQL_EXPORT_TOKENS)
+        with open(path, "w", encoding="utf-8") as f:
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    return n
+                f.write("".join(f"{r[0]}\n" for r in rows))
+                n += len(rows)
+    return await _db_run(_q)
+
+
+async def db_set_tenant(short: str, tenant_id: str, validated_at: float):
     try:
-        with _conn() as c:
-            c.execute("""
-                INSERT INTO lifetime_stats (short, total_hb_ok, total_hb_fail, total_uptime_secs, first_seen)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(short) DO UPDATE SET
-                    total_hb_ok = total_hb_ok + excluded.total_hb_ok,
-                    total_hb_fail = total_hb_fail + excluded.total_hb_fail,
-                    total_uptime_secs = total_uptime_secs + excluded.total_uptime_secs
-            """, (short, hb_ok, hb_fail, uptime_delta, time.time()))
+        await _db_run(lambda c: c.execute(_SQL_SET_TENANT, (tenant_id, validated_at, short)))
     except Exception as e:
-        print(f"[DB] update_lifetime: {e}")
+        console_print(f"[DB] set_tenant: {e}")
 
 
-def db_get_lifetime(short: str):
+async def db_delete_token(short: str):
     try:
-        with _conn() as c:
-            return c.execute("SELECT * FROM lifetime_stats WHERE short=?", (short,)).fetchone()
+        await _db_run(lambda c: c.execute(_SQL_DELETE_TOKEN, (short,)))
     except Exception as e:
-        print(f"[DB] get_lifetime: {e}")
-        return None
+        console_print(f"[DB] delete_token: {e}")
+
+
+async def db_save_checkpoints(rows: list):
+    try:
+        await _db_run(lambda c: c.executemany(_SQL_SAVE_CHECKPOINT, rows))
+    except Exception as e:
+        console_print(f"[DB] save_checkpoints: {e}")
+
+
+async def db_take_checkpoints(keys) -> dict:
+    """Đọc checkpoint của các key rồi xóa luôn, để checkpoint chỉ được dùng một lần."""
+    keys = set(keys)
+
+    def _q(c):
+        rows = [r for r in c.execute(_SQL_LOAD_CHECKPOINTS).fetchall() if r["short"] in keys]
+        c.executemany(_SQL_DELETE_CHECKPOINT, [(r["short"],) for r in rows])
+        return rows
+    try:
+        return {r["short"]: r for r in await _db_run(_q)}
+    except Exception as e:
+        console_print(f"[DB] take_checkpoints: {e}")
+        return {}
+
+
+async def db_load_tokens():
+    try:
+        return await _db_run(lambda c: c.execute(_SQL_LOAD_TOKENS).fetchall())
+    except Exception as e:
+        console_print(f"[DB] load_tokens: {e}")
+        return []
+
+
+async def db_update_lifetime_many(rows: list[tuple]):
+    """Ghi delta stats của nhiều session trong một transaction. rows: (short, hb_ok, hb_fail, uptime_delta).
+
+    Cùng transaction đó cộng delta vào bucket phút hiện tại của hb_series.
+    """
+    now    = clock.now()
+    minute = int(now) - int(now) % SERIES_MINUTE
+    params = [(k, ok, fail, up, now) for k, ok, fail, up in rows]
+    series = [(k, SERIES_MINUTE, minute, ok, fail, up) for k, ok, fail, up in rows]
+
+    def _q(c):
+        c.executemany(_SQL_UPDATE_LIFETIME, params)
+        c.executemany(_SQL_ADD_SERIES, series)
+    await _db_run(_q)
+    for row in rows:
+        _lifetime_add(*row)
+
+
+def _rollup(c: sqlite3.Connection, from_res: int, to_res: int, until: int):
+    """Gộp các bucket from_res trong [mốc cũ, until) lên to_res, rồi dời mốc tới until."""
+    row   = c.execute(_SQL_GET_ROLLUP, (to_res,)).fetchone()
+    since = row[0] if row else 0
+    if until <= since:
+        return
+    c.execute(_SQL_ROLLUP_SERIES, {"from_res": from_res, "to_res": to_res, "since": since, "until": until})
+    c.execute(_SQL_SET_ROLLUP, (to_res, until))
+
+
+async def db_compact_series(now: float = None):
+    """Gộp phút -> giờ, giờ -> ngày cho các giờ/ngày đã kết thúc, xóa bucket cũ đã gộp."""
+    now  = int(now if now is not None else clock.now())
+    hour = now - now % SERIES_HOUR
+    day  = now - now % SERIES_DAY
+
+    def _q(c):
+        _rollup(c, SERIES_MINUTE, SERIES_HOUR, hour)
+        _rollup(c, SERIES_HOUR, SERIES_DAY, day)
+        c.execute(_SQL_PRUNE_SERIES, (SERIES_MINUTE, min(hour, now - SERIES_KEEP_MINUTES)))
+        c.execute(_SQL_PRUNE_SERIES, (SERIES_HOUR, min(day, now - SERIES_KEEP_HOURS)))
+    await _db_run(_q)
+
+
+async def db_query_series(since: float, res: int, short_key: str = None) -> list:
+    """Tổng hb_ok/hb_fail/uptime theo bucket res từ since tới nay, của một session hoặc cả farm.
+
+    Bucket thô chưa được gộp (sau mốc rolled_until) được cộng thêm lúc đọc nên số liệu luôn đủ.
+    """
+    since = int(since) - int(since) % res
+    finer = [r for r in (SERIES_MINUTE, SERIES_HOUR, SERIES_DAY) if r < res]
+
+    def _q(c):
+        marks = {r: v for r, v in c.execute("SELECT res, rolled_until FROM hb_series_rollup")}
+        parts, args = [], []
+        for r in (*finer, res):
+            # bucket r đã được gộp lên mức trên trước mốc của mức đó — chỉ lấy phần chưa gộp
+            upper = next((u for u in (SERIES_HOUR, SERIES_DAY) if u > r and u <= res), None)
+            lower = max(since, marks.get(upper, 0)) if upper else since
+            cond  = "res=? AND bucket>=?" + (" AND short=?" if short_key else "")
+            parts.append(f"SELECT bucket - bucket % ? AS b, hb_ok, hb_fail, uptime_secs FROM hb_series WHERE {cond}")
+            args += [res, r, lower] + ([short_key] if short_key else [])
+        sql = (f"SELECT b, SUM(hb_ok), SUM(hb_fail), SUM(uptime_secs) FROM ({' UNION ALL '.join(parts)}) "
+               f"GROUP BY b ORDER BY b")
+        return c.execute(sql, args).fetchall()
+    return await _db_run(_q)
+
+
+async def db_prune_logs(now: float = None):
+    """Xóa log cũ hơn LOG_KEEP_SECS và phần vượt LOG_KEEP_ROWS dòng mới nhất."""
+    now = now if now is not None else clock.now()
+
+    def _q(c):
+        c.execute(_SQL_PRUNE_LOGS_AGE, (now - LOG_KEEP_SECS,))
+        c.execute(_SQL_PRUNE_LOGS_ROWS, (LOG_KEEP_ROWS,))
+    await _db_run(_q)
+
+
+async def db_export_logs(path: str, since: float, tail: str = None, min_level: str = "info",
+                         max_bytes: int = None, batch: int = 500) -> tuple[int, bool]:
+    """Ghi log từ since tới nay ra file theo thứ tự thời gian, đọc từng lô trên luồng DB.
+
+    Trả (số dòng, bị cắt vì vượt max_bytes).
+    """
+    rank   = _LEVEL_RANK.get(min_level, 0)
+    levels = [lv for lv, r in _LEVEL_RANK.items() if r >= rank]
+    cond   = "ts>=?" + (" AND tail=?" if tail else "")
+    args   = [since] + ([tail] if tail else [])
+    if len(levels) < len(_LEVEL_RANK):
+        cond += f" AND level IN ({','.join('?' * len(levels))})"
+        args += levels
+
+    def _q(c):
+        n = size = 0
+        cur = c.execute(f"SELECT ts, tail, level, msg FROM logs WHERE {cond} ORDER BY ts", args)
+        with open(path, "w", encoding="utf-8") as f:
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    return n, False
+                for ts, tl, lv, msg in rows:
+                    line = f"{datetime.fromtimestamp(ts):%Y-%m-%d %H:%M:%S} [{tl}] {lv:<7} {msg}\n"
+                    size += len(line.encode("utf-8"))
+                    if max_bytes and size > max_bytes:
+                        return n, True
+                    f.write(line)
+                    n += 1
+    return await _db_run(_q)
 
 
 def short(token: str) -> str:
@@ -143,26 +681,306 @@ def make_headers(token: str) -> dict:
     return {**HEADERS_BASE, "Authorization": token}
 
 
-async def _do_request(func):
-    for attempt in range(5):
-        try:
-            return await func()
-        except (asyncio.TimeoutError, aiohttp.ClientError):
-            if attempt < 4:
-                await asyncio.sleep(min(3 * (2 ** attempt), 60))
-        except Exception:
-            if attempt < 4:
-                await asyncio.sleep(3)
-    return None
+def afk_url(tenant_id: str, action: str) -> str:
+    return f"{BASE}/api/tenants/{tenant_id}/rewards/afk/{action}"
+
+
+# --- Đo đạc: histogram bucket cố định cho độ trễ request, số lần retry, độ lệch nhịp HB, lag event loop ---
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 15, 30, 60)
+RETRY_BUCKETS   = (0, 1, 2, 3, 4)
+DRIFT_BUCKETS   = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+LAG_BUCKETS     = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2)
+LOOP_LAG_INTERVAL = 0.5  # giây giữa hai lần đo lag event loop
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # phần tử cuối: vượt bucket lớn nhất
+        self.count  = 0
+        self.sum    = 0.0
+        self.max    = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.count += 1
+        self.sum   += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """Ước lượng phân vị q bằng nội suy tuyến tính trong bucket chứa nó."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                upper = min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+                return lower + (max(upper, lower) - lower) * (rank - seen) / c
+            seen += c
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg":   self.sum / self.count if self.count else 0.0,
+            "p50":   self.quantile(0.50),
+            "p99":   self.quantile(0.99),
+            "max":   self.max,
+        }
+
+    def merge(self, other: "Histogram"):
+        """Cộng dồn histogram cùng bounds (gom số liệu từ nhiều shard)."""
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum   += other.sum
+        self.max    = max(self.max, other.max)
+
+    def to_dict(self) -> dict:
+        return {"bounds": self.bounds, "counts": self.counts, "count": self.count,
+                "sum": self.sum, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Histogram":
+        h = cls(tuple(d["bounds"]))
+        h.counts, h.count, h.sum, h.max = list(d["counts"]), d["count"], d["sum"], d["max"]
+        return h
+
+
+# Histogram toàn cục: "<loại>_latency" / "<loại>_retries" (loại: heartbeat, start, tenants, ...),
+# "hb_drift" (thực tế - dự kiến) và "loop_lag"
+metrics: dict[str, Histogram] = {
+    "hb_drift": Histogram(DRIFT_BUCKETS),
+    "loop_lag": Histogram(LAG_BUCKETS),
+    "db_flush": Histogram(LAG_BUCKETS),
+}
+# Bộ đếm cộng dồn từ lúc process chạy
+counters = {"hb_ok": 0, "hb_fail": 0, "db_flush_rows": 0, "db_flush_errors": 0,
+            "stop_sent": 0, "stop_skipped": 0, "start_conflict": 0, "throttled": 0}
+_loop_lag_task: asyncio.Task = None
+
+
+def _hist(name: str, bounds: tuple) -> Histogram:
+    h = metrics.get(name)
+    if h is None:
+        h = metrics[name] = Histogram(bounds)
+    return h
+
+
+def observe_request(kind: str, latency: float, retries: int, s: "Session" = None):
+    _hist(f"{kind}_latency", LATENCY_BUCKETS).observe(latency)
+    _hist(f"{kind}_retries", RETRY_BUCKETS).observe(retries)
+    if s is not None and kind == "heartbeat":
+        s.hb_latency.observe(latency)
+        s.retries += retries
+
+
+def observe_drift(s: "Session", drift: float):
+    metrics["hb_drift"].observe(drift)
+    s.hb_drift.observe(drift)
+
+
+async def _loop_lag_monitor():
+    while True:
+        t0 = clock.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics["loop_lag"].observe(max(clock.monotonic() - t0 - LOOP_LAG_INTERVAL, 0.0))
+
+
+def start_loop_monitor():
+    global _loop_lag_task
+    if _loop_lag_task is None or _loop_lag_task.done():
+        _loop_lag_task = asyncio.create_task(_loop_lag_monitor())
+
+
+# --- Ngắt mạch + giới hạn tốc độ chung cho mọi request tới Altare ---
+# closed: gửi bình thường qua token bucket. Lỗi liên tiếp (timeout, lỗi mạng, 5xx, 429) của
+# mọi session cộng dồn; đủ BREAKER_THRESHOLD thì open: không gửi gì trong cooldown, các job tự
+# hoãn. Hết cooldown -> half_open: đúng một request được đi làm probe. Probe ok -> closed và tốc
+# độ tăng dần trong BREAKER_RAMP giây: job bị hoãn được thả ra với tốc độ tăng tuyến tính
+# (afk._hold), và nếu bật API_RATE thì token bucket cũng tăng từ 10%; probe lỗi -> open lại với
+# cooldown gấp đôi.
+# Token bucket chỉ bật khi đặt API_RATE (chưa đo được giới hạn thật của Altare). Request không
+# kịp lấy lượt trước hạn chót thì không được gửi và báo RATE_LIMITED_ERR, không tính là lỗi.
+API_RATE             = float(os.getenv("API_RATE", "0"))            # request/giây tối đa; 0 = không giới hạn
+API_BURST            = float(os.getenv("API_BURST", "100"))         # số request dồn được khi rảnh
+BREAKER_THRESHOLD    = int(os.getenv("BREAKER_THRESHOLD", "20"))    # lỗi liên tiếp để ngắt mạch
+BREAKER_COOLDOWN     = float(os.getenv("BREAKER_COOLDOWN", "30"))   # giây chờ trước probe đầu tiên
+BREAKER_COOLDOWN_MAX = 300   # cooldown tối đa sau nhiều probe lỗi
+BREAKER_PROBE_WAIT   = 5     # giây các job khác chờ khi probe đang chạy
+BREAKER_PROBE_MAX    = 30    # probe không báo kết quả sau chừng này giây (task bị hủy) thì cho probe khác
+BREAKER_RAMP         = 60    # giây để tốc độ request tăng về bình thường sau khi đóng mạch
+CIRCUIT_OPEN_ERR     = "API Altare đang lỗi — tạm ngưng gửi request"
+RATE_LIMITED_ERR     = "Vượt API_RATE — request chưa được gửi"
+
+_breaker = {
+    "state": "closed", "fails": 0, "open_until": 0.0, "cooldown": BREAKER_COOLDOWN,
+    "probing": False, "probe_at": 0.0, "closed_at": 0.0, "trips": 0, "rejected": 0,
+}
+_bucket = {"tokens": API_BURST, "ts": 0.0, "waited": 0.0}
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    pass
+
+
+def _rate_factor(now: float) -> float:
+    if not _breaker["closed_at"]:
+        return 1.0
+    return min(1.0, 0.1 + 0.9 * (now - _breaker["closed_at"]) / BREAKER_RAMP)
 
 
-async def detect_tenant(http: aiohttp.ClientSession, token: str) -> Optional[tuple]:
-    async def _req():
-        async with http.get(
+def breaker_wait() -> float:
+    """Số giây job nên hoãn trước khi gọi API; 0 nghĩa là được gửi."""
+    b = _breaker
+    if b["state"] == "closed":
+        return 0.0
+    now = clock.monotonic()
+    if b["state"] == "open":
+        if now < b["open_until"]:
+            return b["open_until"] - now
+        b["state"] = "half_open"
+    if b["probing"] and now - b["probe_at"] > BREAKER_PROBE_MAX:
+        b["probing"] = False
+    return BREAKER_PROBE_WAIT if b["probing"] else 0.0
+
+
+def breaker_record(ok: bool):
+    """Ghi kết quả một lần gọi API: ok=False với timeout/lỗi mạng/5xx/429."""
+    b = _breaker
+    if ok:
+        b["fails"] = 0
+        if b["state"] != "closed":
+            b["state"], b["probing"], b["cooldown"] = "closed", False, BREAKER_COOLDOWN
+            b["closed_at"] = clock.monotonic()
+            _bucket["tokens"] = 0.0  # tăng dần từ đầu, không xả cả burst một lúc
+            add_farm_log("API Altare đã ổn — chạy lại, tăng dần tốc độ request", "success")
+        return
+    b["fails"] += 1
+    if b["state"] == "half_open" or (b["state"] == "closed" and b["fails"] >= BREAKER_THRESHOLD):
+        if b["state"] == "half_open":
+            b["cooldown"] = min(b["cooldown"] * 2, BREAKER_COOLDOWN_MAX)
+        b["state"], b["probing"] = "open", False
+        b["open_until"] = clock.monotonic() + b["cooldown"]
+        b["trips"] += 1
+        add_farm_log(f"API Altare lỗi {b['fails']} lần liên tiếp — tạm ngưng {b['cooldown']:g}s", "error")
+
+
+async def _api_acquire(end: float) -> bool:
+    """Xin phép gửi một request trước hạn end. Raise CircuitOpen nếu đang ngắt mạch."""
+    if breaker_wait() > 0:
+        _breaker["rejected"] += 1
+        raise CircuitOpen()
+    if _breaker["state"] == "half_open":
+        _breaker["probing"]  = True  # request này là probe, không qua bucket
+        _breaker["probe_at"] = clock.monotonic()
+        return True
+    if API_RATE <= 0:
+        return True
+    now    = clock.monotonic()
+    factor = _rate_factor(now)
+    rate   = API_RATE * factor
+    _bucket["tokens"] = min(_bucket["tokens"] + (now - _bucket["ts"]) * rate, max(API_BURST * factor, 1.0))
+    _bucket["ts"]     = now
+    wait = max(1.0 - _bucket["tokens"], 0.0) / rate
+    if now + wait > end:
+        return False
+    _bucket["tokens"] -= 1.0  # giữ chỗ trước, các request sau xếp hàng phía sau
+    if wait > 0:
+        _bucket["waited"] += wait
+        await asyncio.sleep(wait)
+    return True
+
+
+def breaker_stats() -> dict:
+    breaker_wait()  # cập nhật open -> half_open nếu đã hết cooldown
+    now = clock.monotonic()
+    return {
+        "state":    _breaker["state"],
+        "fails":    _breaker["fails"],
+        "trips":    _breaker["trips"],
+        "rejected": _breaker["rejected"],
+        "rate":     round(API_RATE * _rate_factor(now), 2),
+        "waited":   round(_bucket["waited"], 2),
+    }
+
+
+class RetryPolicy(NamedTuple):
+    attempts: int   # số lần thử tối đa
+    connect: float  # timeout mở kết nối TCP/TLS mỗi lần thử
+    total: float    # timeout cả request mỗi lần thử
+    base: float     # backoff lần đầu, nhân đôi mỗi lần sau
+    cap: float      # backoff tối đa
+    budget: float   # tổng thời gian cho cả lượt gọi (kể cả chờ giữa các lần)
+
+
+# Theo loại request (đoạn cuối URL). heartbeat còn bị chặn thêm bởi hạn chót = lần HB kế tiếp.
+RETRY_POLICIES = {
+    "heartbeat": RetryPolicy(attempts=3, connect=3,  total=8,  base=1, cap=4,  budget=25),
+    "start":     RetryPolicy(attempts=4, connect=5,  total=15, base=2, cap=15, budget=60),
+    "stop":      RetryPolicy(attempts=2, connect=3,  total=10, base=1, cap=2,  budget=15),
+    "tenants":   RetryPolicy(attempts=5, connect=5,  total=15, base=3, cap=30, budget=120),
+    "other":     RetryPolicy(attempts=5, connect=5,  total=15, base=3, cap=60, budget=120),
+}
+RETRY_MIN_ATTEMPT = 1.0  # còn ít hơn số giây này tới hạn chót thì không thử thêm
+
+
+def _backoff(policy: RetryPolicy, attempt: int) -> float:
+    """Backoff lũy thừa có jitter: nửa cố định, nửa ngẫu nhiên để các session không dồn nhịp."""
+    d = min(policy.base * (2 ** attempt), policy.cap)
+    return d / 2 + random.uniform(0, d / 2)
+
+
+async def _do_request(func, kind: str = "other", s: "Session" = None, deadline: float = None):
+    """Gọi func(timeout) theo RetryPolicy của kind; không thử lại quá deadline (clock.monotonic()).
+
+    Mỗi lần thử đi qua _api_acquire; func tự gọi breaker_record với mã HTTP nhận được.
+    """
+    policy = RETRY_POLICIES.get(kind, RETRY_POLICIES["other"])
+    t0, attempts = clock.monotonic(), 0
+    end = t0 + policy.budget if deadline is None else min(t0 + policy.budget, deadline)
+    try:
+        for attempt in range(policy.attempts):
+            # lần đầu luôn được gửi, kể cả khi hạn chót đã sát (HB_INTERVAL nhỏ)
+            if attempt and end - clock.monotonic() < RETRY_MIN_ATTEMPT:
+                break
+            if not await _api_acquire(max(end, clock.monotonic() + RETRY_MIN_ATTEMPT)):
+                if not attempt:
+                    raise RateLimited()  # chưa gửi gì — không phải lỗi của API
+                break
+            attempts += 1
+            left    = max(end - clock.monotonic(), RETRY_MIN_ATTEMPT)
+            timeout = aiohttp.ClientTimeout(total=min(policy.total, left), sock_connect=policy.connect)
+            try:
+                return await func(timeout)
+            except Exception:
+                breaker_record(False)
+            if attempt + 1 < policy.attempts:
+                wait = _backoff(policy, attempt)
+                if end - clock.monotonic() - wait < RETRY_MIN_ATTEMPT:
+                    break
+                await asyncio.sleep(wait)
+        return None
+    finally:
+        observe_request(kind, clock.monotonic() - t0, max(attempts - 1, 0), s)
+
+
+async def detect_tenant(token: str) -> Optional[tuple]:
+    async def _req(timeout):
+        async with get_http().get(
             f"{BASE}/api/tenants",
             headers=make_headers(token),
-            timeout=aiohttp.ClientTimeout(total=15),
+            timeout=timeout,
         ) as r:
+            breaker_record(r.status < 500 and r.status != 429)
             if r.status != 200:
                 return None
             data = await r.json()
@@ -174,50 +992,221 @@ async def detect_tenant(http: aiohttp.ClientSession, token: str) -> Optional[tup
             if not tid:
                 return None
             return (tid,)
-    return await _do_request(_req)
+    try:
+        return await _do_request(_req, "tenants")
+    except (CircuitOpen, RateLimited):
+        return None
 
 
-async def api_post(http: aiohttp.ClientSession, url: str, token: str) -> tuple:
-    async def _req():
-        async with http.post(
+async def api_post(url: str, token: str, s: "Session" = None, deadline: float = None) -> tuple:
+    async def _req(timeout):
+        async with get_http().post(
             url,
             headers=make_headers(token),
             json={},
-            timeout=aiohttp.ClientTimeout(total=15),
+            timeout=timeout,
         ) as r:
+            breaker_record(r.status < 500 and r.status != 429)
             if r.status in (200, 201, 204):
                 return True, None
             text = await r.text()
             return False, f"HTTP {r.status}: {text[:200]}"
     try:
-        result = await _do_request(_req)
+        result = await _do_request(_req, url.rsplit("/", 1)[-1], s, deadline)
         if result is None:
-            return False, "Request thất bại sau 5 lần thử"
+            return False, "Request thất bại (hết lượt thử hoặc quá hạn)"
         return result
+    except CircuitOpen:
+        return False, CIRCUIT_OPEN_ERR
+    except RateLimited:
+        counters["throttled"] += 1
+        return False, RATE_LIMITED_ERR
     except Exception as e:
         return False, str(e)[:200]
 
 
-def new_session(token: str, tenant_id: str, added_at: float = None) -> dict:
-    return {
-        "token": token,
-        "short": short(token),
-        "tenant_id": tenant_id,
-        "afk_running": False,
-        "afk_task": None,
-        "afk_stats_task": None,
-        "farm_start": None,
-        "hb_ok": 0,
-        "hb_fail": 0,
-        "hb_last": None,
-        "afk_status": "idle",
-        "afk_error": None,
-        "logs": [],
-        "added_at": added_at or time.time(),
-        "_last_hb_ok": 0,
-        "_last_hb_fail": 0,
-        "_last_stat_ts": time.time(),
-    }
+LOG_HISTORY = 200  # số dòng log giữ lại mỗi session
+
+
+class LogEntry(NamedTuple):
+    ts: str
+    msg: str
+    level: str
+
+
+class Session:
+    __slots__ = (
+        "token", "short", "tenant_id", "added_at", "validated_at",
+        "afk_running", "afk_status", "afk_error",
+        "farm_start", "hb_ok", "hb_fail", "hb_last", "logs",
+        # delta chưa ghi DB
+        "last_hb_ok", "last_hb_fail",
+        # uptime = thời gian ở trạng thái farming: farm_mark là lúc bắt đầu đoạn đang đếm,
+        # uptime_pending là số giây (kể cả phần lẻ) chưa ghi DB
+        "farm_mark", "uptime_pending",
+        # trạng thái chu kỳ do scheduler quản lý
+        "gen", "cycle", "cycle_start", "hb_count", "start_attempt", "resumed",
+        # trạng thái phía Altare theo những gì đã biết: unknown | stopped | running | idle
+        "remote",
+        # heartbeat chưa được tóm tắt vào log (chế độ gộp log)
+        "win_ok", "win_fail",
+        # đo đạc riêng của session
+        "hb_latency", "hb_drift", "retries",
+        "lock",
+    )
+
+    def __init__(self, token: str, tenant_id: str, added_at: float = None, validated_at: float = None):
+        self.token         = token
+        self.short         = short(token)
+        self.tenant_id     = tenant_id
+        self.added_at      = added_at or clock.now()
+        self.validated_at  = validated_at or 0.0
+        self.afk_running   = False
+        self.afk_status    = "idle"
+        self.afk_error     = None
+        self.farm_start    = None
+        self.hb_ok         = 0
+        self.hb_fail       = 0
+        self.hb_last       = None
+        self.logs: deque   = deque(maxlen=LOG_HISTORY)
+        self.last_hb_ok    = 0
+        self.last_hb_fail  = 0
+        self.farm_mark      = 0.0
+        self.uptime_pending = 0.0
+        self.gen           = 0
+        self.cycle         = 0
+        self.cycle_start   = None
+        self.hb_count      = 0
+        self.start_attempt = 0
+        self.resumed       = False  # đang tiếp tục từ checkpoint, chưa có HB xác nhận
+        self.remote        = "unknown"
+        self.win_ok        = 0
+        self.win_fail      = 0
+        self.hb_latency    = Histogram(LATENCY_BUCKETS)
+        self.hb_drift      = Histogram(DRIFT_BUCKETS)
+        self.retries       = 0
+        self.lock          = asyncio.Lock()
+
+
+def tenant_fresh(validated_at: Optional[float]) -> bool:
+    return bool(validated_at) and clock.now() - validated_at < TENANT_TTL
+
+
+def is_tenant_error(err: Optional[str]) -> bool:
+    return bool(err) and err.startswith(tuple(f"HTTP {c}" for c in TENANT_ERROR_STATUS))
+
+
+async def refresh_tenant(s: Session) -> bool:
+    """Detect lại tenant sau lỗi xác thực/tenant. Trả True nếu tenant_id đã đổi."""
+    if clock.now() - s.validated_at < TENANT_RECHECK_MIN:
+        return False
+    s.validated_at = clock.now()  # chặn các lần kiểm tra chồng nhau
+    result = await detect_tenant(s.token)
+    if not result:
+        return False
+    old = s.tenant_id
+    s.tenant_id = result[0]
+    await db_set_tenant(s.short, s.tenant_id, s.validated_at)
+    if s.tenant_id != old:
+        add_log(s, f"tenant đổi {old} -> {s.tenant_id}", "warn")
+        return True
+    return False
+
+
+def new_session(token: str, tenant_id: str, added_at: float = None, validated_at: float = None) -> Session:
+    return Session(token, tenant_id, added_at, validated_at)
+
+
+def _index_add(s: Session):
+    tail = s.token[-TAIL_LEN:]
+    keys = _tail_index.get(tail)
+    if keys is None:
+        keys = _tail_index[tail] = set()
+        bisect.insort(_tail_sorted, tail)
+    keys.add(s.short)
+
+
+def _index_remove(s: Session):
+    tail = s.token[-TAIL_LEN:]
+    keys = _tail_index.get(tail)
+    if keys is None:
+        return
+    keys.discard(s.short)
+    if not keys:
+        del _tail_index[tail]
+        i = bisect.bisect_left(_tail_sorted, tail)
+        if i < len(_tail_sorted) and _tail_sorted[i] == tail:
+            del _tail_sorted[i]
+
+
+def shard_of(key: str, count: int) -> int:
+    return zlib.crc32(key.encode()) % count
+
+
+def owns_key(key: str) -> bool:
+    return SHARD_COUNT <= 1 or shard_of(key, SHARD_COUNT) == SHARD_INDEX
+
+
+def lookup_tail(tail: str) -> list[str]:
+    """Tìm key session theo đuôi token. Trả nhiều key nếu tail bị trùng — nhập dài hơn 8 ký tự để phân biệt."""
+    tail = tail.strip()
+    if len(tail) < TAIL_LEN:
+        return []
+    keys = _tail_index.get(tail[-TAIL_LEN:], ())
+    return [k for k in keys if k in sessions and sessions[k].token.endswith(tail)]
+
+
+def tails_with_prefix(prefix: str, limit: int = 25) -> list[str]:
+    prefix = prefix.strip()
+    out = []
+    for i in range(bisect.bisect_left(_tail_sorted, prefix), len(_tail_sorted)):
+        tail = _tail_sorted[i]
+        if not tail.startswith(prefix) or len(out) >= limit:
+            break
+        out.append(tail)
+    return out
+
+
+async def add_session(s: Session) -> bool:
+    """Đăng ký session mới. Trả False nếu key đã tồn tại."""
+    async with registry_lock:
+        if s.short in sessions:
+            return False
+        sessions[s.short] = s
+        _index_add(s)
+        status_counts[s.afk_status] = status_counts.get(s.afk_status, 0) + 1
+        return True
+
+
+async def remove_session(key: str) -> Optional[Session]:
+    async with registry_lock:
+        s = sessions.pop(key, None)
+        if s is not None:
+            _index_remove(s)
+            status_counts[s.afk_status] -= 1
+    if s is not None:
+        async with s.lock:
+            s.afk_running = False  # job còn treo trong scheduler sẽ tự bỏ qua
+    return s
+
+
+def set_status(s: Session, status: str):
+    """Đổi afk_status, giữ status_counts khớp và cộng dồn thời gian farming.
+
+    Session đã bị gỡ thì không đụng status_counts.
+    """
+    old = s.afk_status
+    if old == status:
+        return
+    s.afk_status = status
+    now = clock.now()
+    if old == "farming":
+        s.uptime_pending += now - s.farm_mark
+    if status == "farming":
+        s.farm_mark = now
+    if sessions.get(s.short) is s:
+        status_counts[old] -= 1
+        status_counts[status] = status_counts.get(status, 0) + 1
 
 
 # Prefix và format cho từng level
@@ -229,59 +1218,67 @@ _LEVEL_FMT = {
 }
 
 
-def add_log(s: dict, msg: str, level: str = "info"):
-    if not s:
-        return
-    ts   = datetime.now().strftime("%H:%M:%S")
-    tail = s["short"][-8:]
+_LEVEL_RANK = {"info": 0, "success": 1, "warn": 2, "error": 3}
+_MIN_RANK   = _LEVEL_RANK.get(LOG_LEVEL, 0)
 
-    s["logs"].append({"ts": ts, "msg": msg, "level": level})
-    s["logs"] = s["logs"][-200:]
 
+def _emit_log(tail: str, msg: str, level: str) -> str:
+    now = clock.now()
+    ts  = datetime.fromtimestamp(now).strftime("%H:%M:%S")
     console_fmt, discord_fmt = _LEVEL_FMT.get(level, _LEVEL_FMT["info"])
-    console_line = console_fmt.format(ts=ts, tail=tail, msg=msg)
-    discord_line = discord_fmt.format(ts=ts, tail=tail, msg=msg)
+    console_print(console_fmt.format(ts=ts, tail=tail, msg=msg))
+    _enqueue_log(discord_fmt.format(ts=ts, tail=tail, msg=msg), level)
+    if _log_store is not None:
+        if len(_log_store) == _log_store.maxlen:
+            _log_store_stats["dropped"] += 1
+        _log_store.append((now, tail, level, msg))
+    return ts
 
-    print(console_line)
 
-    if _log_queue is not None:
-        try:
-            _log_queue.put_nowait(discord_line)
-        except asyncio.QueueFull:
-            pass  # bỏ qua nếu hàng đợi đầy
+def log_enabled(level: str) -> bool:
+    return _LEVEL_RANK.get(level, 0) >= _MIN_RANK
+
+
+def add_log(s: Session, msg: str, level: str = "info"):
+    if not s or not log_enabled(level):
+        return
+    ts = _emit_log(s.short[-8:], msg, level)
+    s.logs.append(LogEntry(ts, msg, level))  # deque(maxlen) tự bỏ dòng cũ nhất
+
+
+def add_farm_log(msg: str, level: str = "info"):
+    """Log một dòng cho cả farm, không gắn với session nào."""
+    if log_enabled(level):
+        _emit_log("farm", msg, level)
 
 
 def uptime_str(farm_start: Optional[float]) -> str:
     if not farm_start:
         return "--:--:--"
-    elapsed = int(time.time() - farm_start)
+    elapsed = int(clock.now() - farm_start)
     h, rem = divmod(max(elapsed, 0), 3600)
     m, sec = divmod(rem, 60)
     return f"{h:02d}:{m:02d}:{sec:02d}"
 
 
-def session_snapshot(s: dict) -> dict:
-    total_hb = s["hb_ok"] + s["hb_fail"]
-    lt = db_get_lifetime(s["short"])
+def session_snapshot(s: Session) -> dict:
+    total_hb = s.hb_ok + s.hb_fail
+    lt = lifetime.get(s.short)
     return {
-        "short": s["short"],
-        "token": s["token"],
-        "token_tail": s["token"][-8:],
-        "tenant_id": s["tenant_id"],
-        "afk_running": s["afk_running"],
-        "farm_start": s["farm_start"],
-        "hb_ok": s["hb_ok"],
-        "hb_fail": s["hb_fail"],
-        "hb_last": s["hb_last"],
-        "afk_status": s["afk_status"],
-        "afk_error": s["afk_error"],
-        "logs": s["logs"],
-        "added_at": s["added_at"],
-        "success_rate": round(s["hb_ok"] / total_hb * 100, 1) if total_hb else 0.0,
-        "uptime": uptime_str(s["farm_start"]),
-        "lifetime": {
-            "total_hb_ok": lt["total_hb_ok"] if lt else 0,
-            "total_hb_fail": lt["total_hb_fail"] if lt else 0,
-            "total_uptime_secs": lt["total_uptime_secs"] if lt else 0,
-        } if lt else {},
+        "short": s.short,
+        "token": s.token,
+        "token_tail": s.token[-8:],
+        "tenant_id": s.tenant_id,
+        "afk_running": s.afk_running,
+        "farm_start": s.farm_start,
+        "hb_ok": s.hb_ok,
+        "hb_fail": s.hb_fail,
+        "hb_last": s.hb_last,
+        "afk_status": s.afk_status,
+        "afk_error": s.afk_error,
+        "logs": tuple(s.logs),
+        "added_at": s.added_at,
+        "success_rate": round(s.hb_ok / total_hb * 100, 1) if total_hb else 0.0,
+        "uptime": uptime_str(s.farm_start),
+        "lifetime": dict(lt) if lt else {},
     }
@@ -1,13 +1,51 @@
+import signal
 import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
 
 async def main():
-    from func.state import db_init
+    from func.state import (
+        db_init, db_load_lifetime, db_close, close_http, start_log_store, stop_log_store, flush_console,
+    )
     from func.bot import run_bot
-    db_init()
-    await run_bot()
+    from func.afk import stop_scheduler, stop_stats_flusher, checkpoint_sessions, SHUTDOWN_DRAIN
+    from func.metrics import start_metrics_server, stop_metrics_server
+    from func.shard import SHARDS, start_shards, stop_shards
+    try:
+        # systemd/Docker dừng bằng SIGTERM: hủy task chính như Ctrl+C để chạy phần tắt êm bên dưới
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass  # Windows
+    if SHARDS:
+        # process này chỉ chạy bot, farm nằm trong các process shard
+        await start_shards()
+        await start_metrics_server()
+        try:
+            await run_bot()
+        finally:
+            await stop_metrics_server()
+            await stop_shards()
+            await db_close()  # kết nối đọc của /xuat-token
+            flush_console()
+        return
+    await db_init()
+    await db_load_lifetime()
+    start_log_store()
+    await start_metrics_server()
+    try:
+        await run_bot()
+    finally:
+        await stop_metrics_server()
+        await stop_scheduler(SHUTDOWN_DRAIN)
+        await stop_stats_flusher()
+        await checkpoint_sessions()
+        await stop_log_store()
+        await close_http()
+        await db_close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        pass  # SIGTERM: đã tắt êm trong main()